@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import gc
+import os
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+from markov import Markov
+
+
+def bench_order(brain_file: str, order: int, generations: int):
+    """Build a brain of the given order from brain_file and measure its memory and generation speed"""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'bench.out')
+
+        started = perf_counter()
+        brain = Markov(brain_file, output, None, [], order=order)
+        build_seconds = perf_counter() - started
+        del brain
+        gc.collect()
+
+        # build again under tracemalloc, which is too slow to time the first build with
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        brain = Markov(brain_file, output, None, [], order=order)
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        words = 0
+        started = perf_counter()
+        for _ in range(generations):
+            words += len(brain.generate_markov_text().split())
+        gen_seconds = perf_counter() - started
+
+    return {
+        'order': order,
+        'contexts': brain.context_count,
+        'nodes': brain.node_count,
+        'edges': brain.edge_count,
+        'traced MiB': traced / 1024 / 1024,
+        'estimate MiB': brain.approx_bytes / 1024 / 1024,
+        'estimate err%': 100 * (brain.approx_bytes - traced) / traced,
+        'build s': build_seconds,
+        'gen/s': generations / gen_seconds,
+        'words/gen': words / generations,
+    }
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser(description="Compare memory and generation speed of brains of different orders")
+    argparser.add_argument('--brain', '-b', type=str, default='codebro.yaml', help="""Brain (yaml or text) to build from""")
+    argparser.add_argument('--orders', '-n', type=int, nargs='+', default=[1, 2, 3, 4], help="""Orders to compare""")
+    argparser.add_argument('--generations', '-g', type=int, default=5000, help="""Responses to generate per order""")
+    args = argparser.parse_args()
+
+    results = [bench_order(args.brain, order, args.generations) for order in args.orders]
+    columns = list(results[0].keys())
+    print('  '.join(f'{c:>12}' for c in columns))
+    for result in results:
+        print('  '.join(f'{result[c]:>12.2f}' if isinstance(result[c], float) else f'{result[c]:>12}'
+                        for c in columns))
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""
+Standalone brain service, so several front-ends (say, Discord on one node and Slack on another) can share one
+Markov graph instead of each learning its own.
+
+Protocol: every message is a 4 byte big-endian length followed by that many bytes of compact JSON.
+Requests are [id, op, *args] with id > 0, replies are [id, ok, result] (result is the error text when ok is false).
+A client can send any number of requests before reading the replies. Each connection's requests are handled in order;
+match replies to requests by id. Messages with id 0 are pushed by the server: [0, "learned", instance, offset,
+[token seqs]] goes to every subscribed read replica when the brain learns. instance is a random id the server picks at
+startup; offsets only mean anything within one instance, since a restarted server's log starts again at 0.
+Only learning is replicated, not pruning: a replica that should stay under a size budget needs its own --max_edges
+and/or --max_graph_mb, and what it forgets can differ from what the server forgets.
+
+Ops:
+    respond prompt learn slack   create_response on the shared brain, learning from prompt if asked to
+    learn prompt                 learn from prompt without generating anything
+    subscribe since              start receiving learned token sequences, replaying the log from offset since;
+                                 returns [instance, offset the log has reached]
+    ping                         returns "pong"
+
+Try it locally:
+    ./brain_server.py --listen unix:/tmp/codebro.sock --brain blah.yaml --output meh.brain --name dumdum
+    ./brain_server.py --connect unix:/tmp/codebro.sock --prompt "hello dumdum"
+    ./main.py --brain_server unix:/tmp/codebro.sock --local_server_port 9966 --name dumdum
+"""
+
+import asyncio
+import json
+import logging
+import struct
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from brain_setup import add_brain_arguments, build_brain
+from graph_pruner import GraphPruner
+from markov import Markov, rotate_brain
+
+_HEADER = struct.Struct('>I')
+MAX_FRAME_BYTES = 1024 * 1024
+PUSH_ID = 0
+
+
+def parse_address(address: str) -> Tuple[str, Any]:
+    """"unix:/path/to.sock" or "[tcp:]host:port" => ("unix", path) or ("tcp", (host, port))"""
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    if address.startswith('tcp:'):
+        address = address[len('tcp:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or 'localhost', int(port))
+
+
+async def open_connection(address: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    kind, where = parse_address(address)
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(where)
+    return await asyncio.open_connection(*where)
+
+
+def write_frame(writer: asyncio.StreamWriter, message: list):
+    payload = json.dumps(message, separators=(',', ':')).encode('utf8')
+    writer.write(_HEADER.pack(len(payload)) + payload)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[list]:
+    """Read one message, or return None at EOF"""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME_BYTES:
+        raise ValueError(f'frame of {length} bytes is over the {MAX_FRAME_BYTES} byte limit')
+    return json.loads(await reader.readexactly(length))
+
+
+class BrainServer:
+    """Hosts a Markov brain for any number of front-end connections.
+
+    Everything learned is appended to a bounded replication log, and pushed to subscribed read replicas, which load
+    the same --brain at startup and then apply the log to stay in step with this one. The log only lives as long as
+    this process, so it's tagged with an instance id that replicas use to notice a restart.
+
+    The brain's response pool, and pruner if one is given, run on the loop alongside the connections."""
+    def __init__(
+            self,
+            brain: Markov,
+            max_log: int = 100000,
+            pruner: Optional[GraphPruner] = None,
+            prune_interval: float = 300.0
+    ):
+        self.brain = brain
+        self.pruner = pruner
+        self.prune_interval = prune_interval
+        self.instance = uuid.uuid4().hex
+        self.log: Deque[List[List[str]]] = deque(maxlen=max_log)
+        # offset of the first entry still in the log
+        self.log_start = 0
+        self._subscribers: List[asyncio.StreamWriter] = list()
+        self._connections: Set[asyncio.StreamWriter] = set()
+
+    @property
+    def log_end(self) -> int:
+        return self.log_start + len(self.log)
+
+    def _learn(self, prompt: str):
+        token_seqs = [seq for seq in self.brain.tokenize(prompt) if seq]
+        if not token_seqs:
+            return
+        self.brain.update_graph_and_corpus(token_seqs)
+
+        if len(self.log) == self.log.maxlen:
+            self.log_start += 1
+        self.log.append(token_seqs)
+        push = [PUSH_ID, 'learned', self.instance, self.log_end - 1, token_seqs]
+        for subscriber in self._subscribers:
+            write_frame(subscriber, push)
+
+    def _respond(self, prompt: str, learn: bool, slack: bool) -> str:
+        response = self.brain.create_response(prompt, learn=False, slack=slack)
+        if learn:
+            self._learn(prompt)
+        return response
+
+    def _subscribe(self, writer: asyncio.StreamWriter, since: int) -> list:
+        if since < self.log_start:
+            logging.warning(f'Replica asked for learned sequences from {since} but the log starts at '
+                            f'{self.log_start}; it will be missing some')
+        for offset in range(max(since, self.log_start), self.log_end):
+            write_frame(writer, [PUSH_ID, 'learned', self.instance, offset, self.log[offset - self.log_start]])
+        if writer not in self._subscribers:
+            self._subscribers.append(writer)
+        return [self.instance, self.log_end]
+
+    def _handle(self, writer: asyncio.StreamWriter, op: str, args: list):
+        if op == 'respond':
+            return self._respond(*args)
+        if op == 'learn':
+            return self._learn(*args)
+        if op == 'subscribe':
+            return self._subscribe(writer, *args)
+        if op == 'ping':
+            return 'pong'
+        raise ValueError(f'unknown op {op}')
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername') or 'unix socket'
+        logging.info(f'Brain server: connection from {peer}')
+        self._connections.add(writer)
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                request_id, op, args = message[0], message[1], message[2:]
+                try:
+                    write_frame(writer, [request_id, True, self._handle(writer, op, args)])
+                except Exception as e:
+                    write_frame(writer, [request_id, False, f'{type(e).__name__}: {e}'])
+                # only actually waits if the client has stopped reading its replies
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            logging.warning(f'Brain server: dropping {peer}: {e}')
+        finally:
+            if writer in self._subscribers:
+                self._subscribers.remove(writer)
+            self._connections.discard(writer)
+            writer.close()
+
+    async def serve(self, address: str):
+        kind, where = parse_address(address)
+        if kind == 'unix':
+            server = await asyncio.start_unix_server(self.handle_connection, where)
+        else:
+            server = await asyncio.start_server(self.handle_connection, *where, reuse_address=True)
+        logging.info(f'Brain server listening on {address}')
+        if self.brain.response_pool is not None:
+            asyncio.create_task(self.brain.response_pool.run())
+        if self.pruner is not None:
+            asyncio.create_task(self.pruner.run(self.prune_interval))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # closing the server only stops new connections; drop the open ones so clients notice and reconnect
+            for writer in list(self._connections):
+                writer.close()
+
+
+class BrainClient:
+    """Pipelined client for a BrainServer. Keeps reconnecting in the background; calls made while disconnected wait
+    for the connection (up to timeout seconds).
+
+    If replica is given, it's a local Markov loaded from the same --brain as the server, and every sequence the server
+    learns is applied to it, so responses can be generated locally without a round trip. If the server restarts, the
+    replica holds sequences the new server instance never learned; reload_replica is then awaited for a fresh one
+    (loaded from --brain again), which catches up from the start of the new instance's log."""
+    def __init__(
+            self,
+            address: str,
+            replica: Optional[Markov] = None,
+            timeout: float = 10.0,
+            reload_replica: Optional[Callable[[], Awaitable[Markov]]] = None
+    ):
+        self.address = address
+        self.replica = replica
+        self.timeout = timeout
+        self.reload_replica = reload_replica
+        # server instance the replica follows, and the next offset in that instance's log it needs
+        self.replica_instance: Optional[str] = None
+        self.replica_offset = 0
+        self._reloading = False
+
+        self._next_id = PUSH_ID + 1
+        self._pending: Dict[int, asyncio.Future] = dict()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+
+    async def run(self, on_connect: Optional[Callable[[], None]] = None, retry_delay: float = 1.0):
+        """Connect, and reconnect whenever the connection drops"""
+        while True:
+            try:
+                reader, self._writer = await open_connection(self.address)
+            except OSError as e:
+                logging.warning(f'Brain client: could not connect to {self.address}: {e}')
+                await asyncio.sleep(retry_delay)
+                continue
+
+            self._connected.set()
+            if self.replica is not None and not self._reloading:
+                self._subscribe()
+            if on_connect is not None:
+                on_connect()
+                on_connect = None
+
+            try:
+                await self._read_replies(reader)
+            except (ConnectionError, ValueError) as e:
+                logging.warning(f'Brain client: connection to {self.address} failed: {e}')
+            finally:
+                self._connected.clear()
+                self._writer.close()
+                self._writer = None
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError('brain server connection lost'))
+                self._pending.clear()
+            await asyncio.sleep(retry_delay)
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        while True:
+            message = await read_frame(reader)
+            if message is None:
+                return
+            if message[0] == PUSH_ID:
+                self._apply_push(message[1], message[2:])
+                continue
+            future = self._pending.pop(message[0], None)
+            if future is None or future.done():
+                continue
+            request_id, ok, result = message
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+    def _apply_push(self, kind: str, args: list):
+        if kind != 'learned' or self.replica is None or self._reloading:
+            return
+        instance, offset, token_seqs = args
+        self._check_instance(instance)
+        if self._reloading or offset < self.replica_offset:
+            return
+        self.replica.update_graph_and_corpus(token_seqs)
+        self.replica_offset = offset + 1
+
+    def _subscribe(self):
+        self._send('subscribe', self.replica_offset).add_done_callback(self._on_subscribed)
+
+    def _on_subscribed(self, future: asyncio.Future):
+        # any replayed sequences arrive before this, but a server with nothing in its log only shows up here
+        if future.cancelled() or future.exception() is not None or self._reloading:
+            return
+        instance, _ = future.result()
+        self._check_instance(instance)
+
+    def _check_instance(self, instance: str):
+        if instance == self.replica_instance:
+            return
+        if self.replica_instance is None:
+            self.replica_instance = instance
+            return
+        if self.reload_replica is None:
+            logging.error(f'Brain client: {self.address} restarted as a new instance, so the local replica holds '
+                          f'learned sequences the server no longer has and will stay out of step with it; '
+                          f'restart this front-end to reload it')
+            self.replica_instance = instance
+            self.replica_offset = 0
+            return
+        logging.warning(f'Brain client: {self.address} restarted as a new instance, reloading the local replica')
+        self._reloading = True
+        asyncio.create_task(self._reload(instance))
+
+    async def _reload(self, instance: str):
+        try:
+            self.replica = await self.reload_replica()
+        except Exception:
+            logging.exception('Brain client: failed to reload the local replica, it will stay out of step')
+        self.replica_instance = instance
+        self.replica_offset = 0
+        self._reloading = False
+        # catch up on everything the new instance has learned, which it replays from its log
+        if self._writer is not None:
+            self._subscribe()
+
+    def _send(self, op: str, *args) -> asyncio.Future:
+        request_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        write_frame(self._writer, [request_id, op, *args])
+        return future
+
+    async def call(self, op: str, *args):
+        await asyncio.wait_for(self._connected.wait(), self.timeout)
+        future = self._send(op, *args)
+        await self._writer.drain()
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def create_response(self, prompt: str = "", learn: bool = False, slack: bool = False) -> str:
+        if self.replica is None:
+            return await self.call('respond', prompt, learn, slack)
+        response = self.replica.create_response(prompt, learn=False, slack=slack)
+        if learn:
+            # the server pushes what it learned back to us, so there's no need to learn locally
+            asyncio.create_task(self._learn_quietly(prompt))
+        return response
+
+    async def _learn_quietly(self, prompt: str):
+        try:
+            await self.call('learn', prompt)
+        except Exception as e:
+            logging.warning(f'Brain client: failed to send learned prompt to {self.address}: {e}')
+
+
+async def _run_client_once(address: str, prompts: List[str]):
+    """Pipeline the prompts to a server and print the replies, for poking at a server by hand"""
+    client = BrainClient(address)
+    runner = asyncio.create_task(client.run())
+    replies = await asyncio.gather(*(client.call('respond', p, False, False) for p in prompts))
+    for reply in replies:
+        print(reply)
+    runner.cancel()
+
+
+if __name__ == '__main__':
+    import configargparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    # shares its config file with the front-ends, so skip their keys (discord_token, brain_server and so on)
+    parser = configargparse.ArgParser(description="CodeBro brain server", ignore_unknown_config_file_keys=True)
+    parser.add_argument("-c", "--config", is_config_file=True, help="Path to config file in yaml format")
+    parser.add_argument("--listen", env_var="CB_BRAIN_LISTEN",
+                        help="Address to serve the brain on, as unix:/path/to.sock or host:port")
+    parser.add_argument("--connect", help="Instead of serving, send --prompt to the server at this address")
+    parser.add_argument("--prompt", nargs='+', default=[""], help="Prompt(s) to send with --connect")
+    parser.add_argument("-b", "--brain", env_var="CB_BRAIN",
+                        help="This bot's input brain as a YAML or newline-delimited text file")
+    parser.add_argument("-o", "--output", env_var="CB_OUTPUT", help="File for writing the real-time updated corpus")
+    parser.add_argument("-n", "--name", env_var="CB_NAME", help="The name this bot will respond to in chats")
+    parser.add_argument("-u", "--user_map", env_var="USER_MAP", required=False, help="Discord-to-Slack user id map")
+    parser.add_argument("-r", "--rotate", env_var="CB_ROTATE", required=False, action="store_true",
+                        help="Backup the brain and copy the output to the brain on shutdown")
+    add_brain_arguments(parser)
+    args = parser.parse_args()
+
+    if args.connect:
+        asyncio.run(_run_client_once(args.connect, args.prompt))
+    else:
+        if not (args.listen and args.brain and args.output and args.name):
+            parser.error("serving needs --listen, --brain, --output and --name")
+        served_brain, graph_pruner = build_brain(args, args.output)
+        brain_server = BrainServer(served_brain, pruner=graph_pruner, prune_interval=args.prune_interval)
+        try:
+            asyncio.run(brain_server.serve(args.listen))
+        except KeyboardInterrupt:
+            if args.rotate:
+                rotate_brain(args.brain, args.output)
@@ -0,0 +1,73 @@
+from typing import Optional, Tuple
+
+from graph_pruner import GraphPruner
+from markov import Markov
+from response_pool import ResponsePool
+
+
+def add_brain_arguments(parser):
+    """Options for building a brain, shared by main.py and brain_server.py"""
+    parser.add_argument(
+        "--order",
+        env_var="CB_ORDER",
+        type=int,
+        default=2,
+        help="Number of preceding words each generated word depends on (a brain server's replicas must use the same)",
+    )
+
+    parser.add_argument(
+        "--response_pool_size",
+        env_var="CB_RESPONSE_POOL_SIZE",
+        type=int,
+        default=50,
+        help="Number of unseeded responses to pre-generate while idle (0 disables the pool)",
+    )
+
+    parser.add_argument(
+        "--response_pool_staleness",
+        env_var="CB_RESPONSE_POOL_STALENESS",
+        type=int,
+        default=25,
+        help="Discard pooled responses once the brain has learned this many new sequences since they were generated",
+    )
+
+    parser.add_argument(
+        "--max_edges",
+        env_var="CB_MAX_EDGES",
+        type=int,
+        required=False,
+        help="Prune rare and stale transitions once the brain holds more than this many",
+    )
+
+    parser.add_argument(
+        "--max_graph_mb",
+        env_var="CB_MAX_GRAPH_MB",
+        type=float,
+        required=False,
+        help="Prune rare and stale transitions once the brain's estimated size goes over this many megabytes",
+    )
+
+    parser.add_argument(
+        "--prune_interval",
+        env_var="CB_PRUNE_INTERVAL",
+        type=float,
+        default=300,
+        help="Seconds between checks of the brain's size budget",
+    )
+
+
+def build_brain(args, output: Optional[str]) -> Tuple[Markov, Optional[GraphPruner]]:
+    """Load --brain with its response pool, and a pruner if there's a budget, pruning straight away if the brain
+    starts out over it. output is None for a read replica, which keeps no corpus of its own."""
+    brain = Markov(args.brain, output, args.user_map, [args.name], order=args.order)
+    if args.response_pool_size > 0:
+        brain.response_pool = ResponsePool(brain, size=args.response_pool_size,
+                                           max_staleness=args.response_pool_staleness)
+
+    graph_pruner = None
+    if args.max_edges or args.max_graph_mb:
+        max_graph_bytes = int(args.max_graph_mb * 1024 * 1024) if args.max_graph_mb else None
+        graph_pruner = GraphPruner(brain, max_edges=args.max_edges, max_bytes=max_graph_bytes)
+        if graph_pruner.over_budget():
+            print(f'Brain is over budget at startup, {graph_pruner.prune()}')
+    return brain, graph_pruner
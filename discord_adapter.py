@@ -0,0 +1,288 @@
+import re
+from typing import Awaitable, Callable, List, Optional
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+import emoji_config
+from custom_emoji_cache import CustomEmojiCache
+from emoji_config import EmojiMapping
+from outbound_queue import OutboundQueue
+from profiler import Profiler
+
+# discord rejects messages over 2000 characters, and allows roughly 5 messages per 5 seconds per channel
+DISCORD_MAX_MESSAGE_LEN = 2000
+
+
+class CodeBroDiscordBot(commands.Bot):
+    """Discord front-end. Only imported by main.py when a discord token is configured, since discord.py is slow to
+    import. Replies come from the respond coroutine, which is main.create_raw_response."""
+    def __init__(
+            self,
+            respond: Callable[..., Awaitable[Optional[str]]],
+            tokenize: Callable[[str], List[str]],
+            guild_ids: List[int],
+            emoji_map_file: Optional[str],
+            on_first_ready: Optional[Callable[[], None]] = None,
+            profiler: Optional[Profiler] = None
+    ):
+        intents = discord.Intents(guild_messages=True, message_content=True)
+        super().__init__(command_prefix='?', intents=intents)
+        self.respond = respond
+        self.tokenize = tokenize
+        self.on_first_ready = on_first_ready
+        self.profiler = profiler
+
+        self.my_emoji_config: emoji_config.EmojiConfig = emoji_config.read_emoji_config(emoji_map_file)
+        self.emoji_config_writer: Optional[emoji_config.EmojiConfigWriter] = None
+        if emoji_map_file is not None and emoji_map_file != '':
+            self.emoji_config_writer = emoji_config.EmojiConfigWriter(emoji_map_file, self.my_emoji_config)
+        self.custom_emoji_cache: CustomEmojiCache = CustomEmojiCache()
+        self.outbound = OutboundQueue('discord', self._send_to_channel, DISCORD_MAX_MESSAGE_LEN, rate=1.0, burst=5)
+
+        self._register_commands([discord.Object(id=i) for i in guild_ids])
+
+    async def on_ready(self):
+        for g in self.guilds:
+            print(f'Starting sync for guild {g.id}...')
+            await self.tree.sync(guild=g)
+            print(f'Synced for guild {g.id}')
+
+        print("Logged in as {0.user}".format(self))
+        if self.on_first_ready is not None:
+            self.on_first_ready()
+            self.on_first_ready = None
+
+    async def on_message(self, message: discord.Message):
+        if message.author == self.user:
+            return
+
+        bot_display_names = [self.user.display_name]
+
+        mentioned = False
+        for mention in message.mentions:
+            if mention.id == self.user.id:
+                mentioned = True
+                break
+
+        await self.try_append_emoji_to_message(message)
+
+        # print(f"Discord message from {message.author}: {message.content}")
+        response = await self.respond(message.content, False, force_mention=mentioned, other_bot_names=bot_display_names)
+        if response and response.strip() != "":
+            self.outbound.enqueue(message.channel.id, message.channel, response)
+
+    @staticmethod
+    async def _send_to_channel(channel: discord.abc.Messageable, text: str):
+        await channel.send(text)
+
+    def _register_commands(self, all_guild_objects: List[discord.Object]):
+        tree = self.tree
+
+        @tree.command(
+            name="add_react",
+            description="Add a reaction emoji config",
+            guilds=all_guild_objects
+        )
+        @app_commands.describe(regex_str='The regex against which each token will be checked (case insensitive)',
+                               emoji_str="The emoji string (either a single unicode character or an emoji's name) to react with")
+        @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
+        async def add_react(ctx: discord.Interaction, regex_str: str, emoji_str: str):
+
+            if not await self.get_user_has_role_for_interaction(ctx, 'admin'):
+                await ctx.response.send_message('Missing permissions for this command')
+                return
+
+            def is_valid_str_arg(arg: str) -> bool:
+                if arg is None or arg == '':
+                    return False
+                return True
+
+            if not is_valid_str_arg(regex_str):
+                await ctx.response.send_message(f'Failed to add emoji since regex \"{regex_str}\" is invalid')
+                return
+
+            if not is_valid_str_arg(emoji_str):
+                await ctx.response.send_message(f'Failed to add emoji since emoji \"{emoji_str}\" is invalid')
+                return
+
+            existing_emoji_mapping = self.my_emoji_config.find_mapping_via_regex_str(regex_str, ctx.guild_id)
+            if existing_emoji_mapping is not None:
+                await ctx.response.send_message(f'Failed to add emoji since regex \"{regex_str}\" already in config')
+                return
+
+            def try_get_regex_pattern(regex_str:str) -> Optional[re.Pattern]:
+                try:
+                    pattern = re.compile(regex_str)
+                    return pattern
+                except:
+                    return None
+
+            new_pattern = try_get_regex_pattern(regex_str)
+            if new_pattern is None:
+                await ctx.response.send_message(f'Failed to add emoji since regex \"{regex_str}\" is invalid')
+                return
+
+            if len(emoji_str) >= 2:
+                custom_emoji = await self.custom_emoji_cache.find_custom_emoji_with_name(ctx.guild, emoji_str, force_refresh_emoji=True)
+                if custom_emoji is None:
+                    msg = f"Failed to add emoji. Couldn't find emoji \"{emoji_str}\""
+                    print(msg)
+                    await ctx.response.send_message(msg)
+                    return
+
+            self.my_emoji_config.add_mapping(EmojiMapping(regex_str, emoji_str, ctx.guild_id))
+
+            if self.emoji_config_writer:
+                self.emoji_config_writer.schedule()
+            await ctx.response.send_message('Added emoji response')
+
+        @tree.command(
+            name="remove_react",
+            description="Remove a reaction emoji config",
+            guilds=all_guild_objects
+        )
+        @app_commands.describe(regex_str='The regex against which each token will be checked (case insensitive)')
+        @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
+        async def remove_react(ctx:discord.Interaction, regex_str:str):
+
+            if not await self.get_user_has_role_for_interaction(ctx, 'admin'):
+                await ctx.response.send_message('Missing permissions for this command')
+                return
+
+            def is_valid_str_arg(arg:str)->bool:
+                if arg is None or arg == '':
+                    return False
+                return True
+
+            if not is_valid_str_arg(regex_str):
+                await ctx.response.send_message(f'Failed to remove emoji since regex \"{regex_str}\" is invalid')
+                return
+
+            removed = self.my_emoji_config.remove_mappings_for_regex(regex_str, ctx.guild_id)
+            if removed > 0:
+                if self.emoji_config_writer:
+                    self.emoji_config_writer.schedule()
+                await ctx.response.send_message(f'Removed emoji react for regex \"{regex_str}\"')
+            else:
+                await ctx.response.send_message(f'Nothing to remove for regex \"{regex_str}\"')
+
+
+        @tree.command(
+            name="list_react",
+            description="List emoji reactions",
+            guilds=all_guild_objects
+        )
+        @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
+        async def list_react(ctx: discord.Interaction):
+
+            if not await self.get_user_has_role_for_interaction(ctx, 'admin'):
+                await ctx.response.send_message('Missing permissions for this command')
+                return
+
+            reply_content = 'Emoji:\n'
+            for emoji_mapping in self.my_emoji_config.emoji_config_list:
+                reply_content += f'{emoji_mapping.regex_str} => {emoji_mapping.emoji_str}\n'
+            await ctx.response.send_message(reply_content)
+
+        @tree.command(
+            name="force_sync",
+            description="Force Sync the bot",
+            guilds=all_guild_objects
+        )
+        @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
+        async def force_sync(ctx: discord.Interaction):
+
+            if not await self.get_user_has_role_for_interaction(ctx, 'admin'):
+                await ctx.response.send_message('Missing permissions for this command')
+                return
+
+            await ctx.response.defer()
+            print(f'Starting sync for guild {ctx.guild.id}...')
+            await tree.sync(guild=ctx.guild)
+            print(f'Synced for guild {ctx.guild.id}')
+            await ctx.followup.send('Forcibly synced')
+
+        @tree.command(
+            name="profile",
+            description="Start or stop profiling the bot, or take a memory snapshot",
+            guilds=all_guild_objects
+        )
+        @app_commands.describe(action='start, stop or snapshot')
+        @app_commands.choices(action=[app_commands.Choice(name=a, value=a) for a in ('start', 'stop', 'snapshot')])
+        @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
+        async def profile(ctx: discord.Interaction, action: app_commands.Choice[str]):
+
+            if not await self.get_user_has_role_for_interaction(ctx, 'admin'):
+                await ctx.response.send_message('Missing permissions for this command')
+                return
+
+            if self.profiler is None:
+                await ctx.response.send_message('Profiling is not configured')
+                return
+
+            if action.value == 'start':
+                self.profiler.start()
+                await ctx.response.send_message('Profiling started')
+                return
+
+            await ctx.response.defer()
+            written = await (self.profiler.stop_async() if action.value == 'stop' else self.profiler.snapshot_async())
+            if written:
+                await ctx.followup.send('Wrote:\n' + '\n'.join(written))
+            else:
+                await ctx.followup.send('Profiling is not running')
+
+    async def get_user_has_role_for_interaction(self, ctx: discord.Interaction, role_name: str) -> bool:
+        """For some reason I couldn't get app_commands.checks.has_role working. Something is missing in the discordpy
+        cache. Since we're using this for really low frequency operations, I just refetch everything here to do
+        checks solidly."""
+        guild = await self.fetch_guild(ctx.guild_id)
+
+        if guild is None:
+            return False
+
+        user: discord.Member = await guild.fetch_member(ctx.user.id)
+
+        if user is None:
+            return False
+
+        guild_roles = await guild.fetch_roles()
+
+        found_role = None
+        for r in guild_roles:
+            if r.name.lower() == role_name.lower():
+                found_role = r
+                break
+
+        if found_role is None:
+            return False
+
+        # For some reason, ctx.user.get_role doesn't work here because ctx.guild has an empty roles dictionary?
+        user_role = user.get_role(found_role.id)
+        return user_role is not None
+
+    async def try_append_emoji_to_message(self, message:discord.Message):
+        msg_tokens = self.tokenize(message.content)
+        reaction_count = 0
+        max_reaction_count = 5
+        for token in msg_tokens:
+            configured_reaction_emoji = self.my_emoji_config.find_emoji_for_message_token(token, message.guild.id)
+            if configured_reaction_emoji is None:
+                continue
+
+            custom_emoji = await self.custom_emoji_cache.find_custom_emoji_with_name(message.guild, configured_reaction_emoji.emoji_str)
+
+            if custom_emoji is not None:
+                await message.add_reaction(custom_emoji)
+                reaction_count += 1
+            else:
+                try:
+                    await message.add_reaction(configured_reaction_emoji.emoji_str)
+                    reaction_count += 1
+                except:
+                    print(f'Failed to add emoji for {configured_reaction_emoji}')
+
+            if reaction_count >= max_reaction_count:
+                break
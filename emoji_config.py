@@ -1,10 +1,19 @@
+import asyncio
+import os
 import re
-from typing import Optional, List, Tuple
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, List, Tuple
 
 import yaml
 
 import discord_helpers
 
+# libyaml's C loader/dumper are much faster on big multi-guild configs; fall back to pure python without it
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class EmojiMapping:
     """Representation of a single regex pattern => emoji string. Regex patterns are case insensitive"""
@@ -24,65 +33,121 @@ class EmojiMapping:
 
 
 class EmojiConfig:
+    """Emoji mappings keyed by guild id and sanitized regex string, so lookups and removals don't scan every guild"""
     def __init__(self, emoji_config_list: List[EmojiMapping]):
-        self.emoji_config_list = emoji_config_list
+        # guild id => sanitized regex str => mapping. dicts keep insertion order, so the first mapping added for a
+        # guild is still the first one tried against message tokens
+        self._mappings_by_guild: Dict[int, Dict[str, EmojiMapping]] = dict()
+        for emoji_mapping in emoji_config_list:
+            self._mappings_by_guild.setdefault(emoji_mapping.guild_id, dict()).setdefault(emoji_mapping.regex_str,
+                                                                                           emoji_mapping)
+
+    @property
+    def emoji_config_list(self) -> List[EmojiMapping]:
+        """All mappings for every guild"""
+        return [m for guild_mappings in self._mappings_by_guild.values() for m in guild_mappings.values()]
 
     def find_mapping_via_regex_str(self, regex_str: str, guild_id: int) -> Optional[EmojiMapping]:
         """Try to find an existing emoji mapping with the same guild id and regex"""
-        regex_str = EmojiMapping.sanitize_regex_str(regex_str)
-
-        for emoji_mapping in self.emoji_config_list:
-            if emoji_mapping.guild_id != guild_id:
-                continue
-
-            if emoji_mapping.regex_str == regex_str.upper():
-                return emoji_mapping
-        return None
+        guild_mappings = self._mappings_by_guild.get(guild_id)
+        if guild_mappings is None:
+            return None
+        return guild_mappings.get(EmojiMapping.sanitize_regex_str(regex_str))
 
     def find_emoji_for_message_token(self, token_str: str, guild_id: int) -> Optional[EmojiMapping]:
         """Try to find the first emoji mapping for the provided guild whose regex matches the token_str"""
-        for emoji_mapping in self.emoji_config_list:
-            if emoji_mapping.guild_id != guild_id:
-                continue
-
+        for emoji_mapping in self._mappings_by_guild.get(guild_id, dict()).values():
             if emoji_mapping.regex_pattern.match(token_str) is not None:
                 return emoji_mapping
         return None
 
     def add_mapping(self, new_emoji_mapping: EmojiMapping):
-        """Add a new mapping"""
-        self.emoji_config_list.append(new_emoji_mapping)
+        """Add a new mapping, replacing any existing one for the same guild and regex"""
+        guild_mappings = self._mappings_by_guild.setdefault(new_emoji_mapping.guild_id, dict())
+        guild_mappings[new_emoji_mapping.regex_str] = new_emoji_mapping
 
     def remove_mappings_for_regex(self, regex_str: str, guild_id: int) -> int:
         """Remove all mappings for a given guild which have the same regex string"""
-        removed = 0
-        mapping = self.find_mapping_via_regex_str(regex_str, guild_id)
-        while mapping is not None:
-            self.emoji_config_list.remove(mapping)
-            removed += 1
-            mapping = self.find_mapping_via_regex_str(regex_str, guild_id)
-        return removed
+        guild_mappings = self._mappings_by_guild.get(guild_id)
+        if guild_mappings is None or guild_mappings.pop(EmojiMapping.sanitize_regex_str(regex_str), None) is None:
+            return 0
+        if not guild_mappings:
+            del self._mappings_by_guild[guild_id]
+        return 1
 
     def get_mappings_for_guild(self, guild_id: int) -> List[EmojiMapping]:
         """Get all mappings for a given guild id"""
-        matching_mappings = list(filter(lambda c: c.guild_id == guild_id, self.emoji_config_list))
-        return matching_mappings
+        return list(self._mappings_by_guild.get(guild_id, dict()).values())
 
 
-def write_emoji_config(filename: str, new_emoji_config: EmojiConfig):
-    yaml_dict = dict()
+def _to_yaml_dict(emoji_config: EmojiConfig) -> dict:
     entry_list = list()
-    yaml_dict['EmojiMappings'] = entry_list
-    for t in new_emoji_config.emoji_config_list:
+    for t in emoji_config.emoji_config_list:
         entry_dict = dict()
         entry_dict['regex'] = t.regex_str
         entry_dict['emoji_str'] = t.emoji_str
         entry_dict['guild_id'] = t.guild_id
         entry_list.append(entry_dict)
+    return {'EmojiMappings': entry_list}
+
+
+def _write_yaml_atomically(filename: str, yaml_dict: dict):
+    """Dump to a temp file next to filename and rename it into place, so readers never see a half-written config"""
+    yaml_content = yaml.dump(yaml_dict, Dumper=_YamlDumper)
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile('w', encoding='utf8', dir=directory, prefix='.emoji_map.', delete=False) as outfile:
+        try:
+            outfile.write(yaml_content)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            # temp files are created 0600; keep whatever permissions the config already had
+            if os.path.exists(filename):
+                shutil.copymode(filename, outfile.name)
+        except:
+            os.unlink(outfile.name)
+            raise
+    os.replace(outfile.name, filename)
+
+
+def write_emoji_config(filename: str, new_emoji_config: EmojiConfig):
+    _write_yaml_atomically(filename, _to_yaml_dict(new_emoji_config))
+
+
+class EmojiConfigWriter:
+    """Saves an EmojiConfig off the event loop, at most once per delay seconds no matter how many changes are made.
+    Writes go through a single worker thread so they land on disk in the order they were scheduled."""
+    def __init__(self, filename: str, emoji_config: EmojiConfig, delay: float = 2.0):
+        self.filename = filename
+        self.emoji_config = emoji_config
+        self.delay = delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='emoji-config-writer')
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def schedule(self):
+        """Note that the config changed. Must be called from the event loop."""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self.delay, self._write_in_background)
+
+    def _write_in_background(self):
+        self._timer = None
+        # snapshot on the loop so the worker never sees the config change under it
+        yaml_dict = _to_yaml_dict(self.emoji_config)
+        future = self._executor.submit(_write_yaml_atomically, self.filename, yaml_dict)
+        future.add_done_callback(self._report_failure)
+
+    @staticmethod
+    def _report_failure(future):
+        if future.exception() is not None:
+            print(f'Error writing emoji config: {future.exception()}')
 
-    yaml_content = yaml.dump(yaml_dict)
-    with open(filename, 'w', encoding='utf8') as outfile:
-        outfile.write(yaml_content)
+    def flush(self):
+        """Write out any pending change right now and wait for all writes to finish, e.g. on shutdown"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._write_in_background()
+        self._executor.shutdown(wait=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='emoji-config-writer')
 
 
 def read_emoji_config(file_name: Optional[str]) -> EmojiConfig:
@@ -90,7 +155,7 @@ def read_emoji_config(file_name: Optional[str]) -> EmojiConfig:
     try:
         if file_name is not None and file_name != '':
             with open(file_name, 'r', encoding='utf8') as infile:
-                yaml_dict = yaml.load(infile.read(), Loader=yaml.Loader)
+                yaml_dict = yaml.load(infile, Loader=_YamlLoader) or dict()
                 emoji_mappings = yaml_dict['EmojiMappings'] if 'EmojiMappings' in yaml_dict else list()
                 for mapping in emoji_mappings:
                     emoji_str = mapping['emoji_str']
@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import logging
+from time import time
+from typing import NamedTuple, Optional
+
+
+class PruneReport(NamedTuple):
+    edges_pruned: int = 0
+    keys_removed: int = 0
+    bytes_reclaimed: int = 0
+    edges_remaining: int = 0
+    seconds: float = 0.0
+
+    def __str__(self):
+        return (f'pruned {self.edges_pruned} edges and {self.keys_removed} keys, '
+                f'reclaimed ~{self.bytes_reclaimed / 1024:.1f} KiB, {self.edges_remaining} edges remaining '
+                f'({self.seconds:.2f}s)')
+
+
+class GraphPruner:
+    """Keeps a Markov brain's graph under an edge and/or approximate memory budget.
+
+    Once the graph goes over budget, transitions are scored by their count decayed by how long ago they were last
+    seen, and the lowest scoring ones are forgotten until the graph is back under low_water of the budget. The brain
+    itself refuses to drop a key's last transition or its shortest path to STOP, so generation can't get stuck.
+    Work is done in chunks so the event loop gets a look in between them."""
+    def __init__(
+            self,
+            brain,
+            max_edges: Optional[int] = None,
+            max_bytes: Optional[int] = None,
+            low_water: float = 0.9,
+            half_life_days: float = 30.0,
+            chunk_size: int = 2000
+    ):
+        if max_edges is None and max_bytes is None:
+            raise ValueError("a pruner needs at least one of max_edges or max_bytes")
+        self.brain = brain
+        self.max_edges = max_edges
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.half_life = half_life_days * 24 * 60 * 60
+        self.chunk_size = chunk_size
+
+    def over_budget(self) -> bool:
+        if self.max_edges is not None and self.brain.edge_count > self.max_edges:
+            return True
+        return self.max_bytes is not None and self.brain.approx_bytes > self.max_bytes
+
+    def _edges_to_prune(self) -> int:
+        excess = 0
+        if self.max_edges is not None:
+            excess = self.brain.edge_count - int(self.max_edges * self.low_water)
+        if self.max_bytes is not None and self.brain.edge_count > 0:
+            bytes_per_edge = self.brain.approx_bytes / self.brain.edge_count
+            excess = max(excess, int((self.brain.approx_bytes - self.max_bytes * self.low_water) / bytes_per_edge))
+        return max(excess, 0)
+
+    def _score(self, count: int, last_seen: float, now: float) -> float:
+        return count * 0.5 ** ((now - last_seen) / self.half_life)
+
+    def _prune_steps(self):
+        """Generator that yields between chunks of work and returns a PruneReport"""
+        started = time()
+        edges_pruned = keys_removed = bytes_reclaimed = 0
+        # pruning can leave other transitions unprunable (a key down to its last one), so keep going until
+        # under low water or until a pass gets nowhere
+        while True:
+            wanted = self._edges_to_prune()
+            if wanted == 0:
+                break
+
+            # keep the `wanted` lowest scores among the transitions the brain will actually give up, in a
+            # max-heap (scores are negated)
+            candidates = []
+            keys = self.brain.prunable_keys()
+            for i, key in enumerate(keys):
+                for j, (next_word, count, last_seen) in enumerate(self.brain.edges_from(key)):
+                    if not self.brain.can_prune(key, next_word):
+                        continue
+                    entry = (-self._score(count, last_seen, started), i, j, next_word)
+                    if len(candidates) < wanted:
+                        heapq.heappush(candidates, entry)
+                    elif entry > candidates[0]:
+                        heapq.heapreplace(candidates, entry)
+                if i % self.chunk_size == self.chunk_size - 1:
+                    yield
+
+            pass_pruned = 0
+            candidates.sort(reverse=True)
+            for n, (_, i, _, next_word) in enumerate(candidates):
+                if pass_pruned >= wanted:
+                    break
+                edges, removed, reclaimed = self.brain.prune_edge(keys[i], next_word)
+                pass_pruned += edges
+                keys_removed += removed
+                bytes_reclaimed += reclaimed
+                if n % self.chunk_size == self.chunk_size - 1:
+                    yield
+            edges_pruned += pass_pruned
+            if pass_pruned == 0:
+                break
+
+        return PruneReport(edges_pruned, keys_removed, bytes_reclaimed, self.brain.edge_count, time() - started)
+
+    def prune(self) -> PruneReport:
+        """Prune in one go, for use outside of the event loop"""
+        steps = self._prune_steps()
+        while True:
+            try:
+                next(steps)
+            except StopIteration as done:
+                return done.value
+
+    async def prune_async(self) -> PruneReport:
+        steps = self._prune_steps()
+        while True:
+            try:
+                next(steps)
+            except StopIteration as done:
+                return done.value
+            await asyncio.sleep(0)
+
+    async def run(self, interval: float = 300.0, max_backoff: int = 16):
+        """Check the budget every interval seconds and prune when it's exceeded. When everything prunable is gone and
+        the graph is still over budget, check less and less often (up to max_backoff intervals apart) and only warn
+        about it once, until a pass gets back under budget."""
+        delay = interval
+        stuck = False
+        while True:
+            await asyncio.sleep(delay)
+            if not self.over_budget():
+                continue
+            report = await self.prune_async()
+            if not self.over_budget():
+                logging.info(f'Graph pruner: {report}')
+                delay = interval
+                stuck = False
+                continue
+            if not stuck:
+                logging.warning(f'Graph pruner: {report}, but still over budget; the rest of the graph is what '
+                                f'keeps every context able to reach STOP, so the budget is too small for this brain')
+                stuck = True
+            else:
+                logging.debug(f'Graph pruner: {report}, still over budget')
+            delay = min(delay * 2, interval * max_backoff)
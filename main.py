@@ -1,26 +1,20 @@
 #!/usr/bin/env python
+from time import perf_counter
+_started = perf_counter()
 
 import asyncio
 import logging
-import os.path
-import re
-import shutil
-import socket
-from typing import Dict, List, Tuple, Optional
+import sys
+from typing import List, Optional, Tuple
 
 import configargparse
-import discord
-from discord import app_commands
-from discord.ext import commands
 
-from slack_bolt.adapter.socket_mode.aiohttp import AsyncSocketModeHandler
-from slack_bolt.async_app import AsyncApp
-
-import emoji_config
-from custom_emoji_cache import CustomEmojiCache
-from emoji_config import EmojiMapping
-from markov import Markov
-from time import time
+from brain_server import BrainClient
+from brain_setup import add_brain_arguments, build_brain
+from graph_pruner import GraphPruner
+from markov import Markov, rotate_brain
+from profiler import Profiler
+from startup_timer import StartupTimer
 
 logging.basicConfig(level=logging.INFO)
 
@@ -53,15 +47,15 @@ parser.add_argument(
     "-b",
     "--brain",
     env_var="CB_BRAIN",
-    required=True,
-    help="This bot's input brain as a YAML or newline-delimited text file, also used as the base name for rotated brains",
+    required=False,
+    help="This bot's input brain as a YAML or newline-delimited text file, also used as the base name for rotated brains (not needed with --brain_server, unless --brain_replica)",
 )
 parser.add_argument(
     "-o",
     "--output",
     env_var="CB_OUTPUT",
-    required=True,
-    help="File for writing the real-time updated corpus",
+    required=False,
+    help="File for writing the real-time updated corpus (not needed with --brain_server)",
 )
 parser.add_argument(
     "-n",
@@ -99,8 +93,8 @@ parser.add_argument(
     "--guild_id",
     env_var="GUILD_ID",
     type=int,
-    required=True,
-    help="Guild ID to register commands to",
+    required=False,
+    help="Guild ID to register commands to (required with --discord_token)",
 )
 
 parser.add_argument(
@@ -111,30 +105,131 @@ parser.add_argument(
     help="Extra Guild IDs to register commands to",
 )
 
+add_brain_arguments(parser)
+
+parser.add_argument(
+    "--outbound_stats_interval",
+    env_var="CB_OUTBOUND_STATS_INTERVAL",
+    type=float,
+    default=300,
+    help="Seconds between logging outbound message queue depth and send latency (0 disables)",
+)
+
+parser.add_argument(
+    "--profile_dir",
+    env_var="CB_PROFILE_DIR",
+    default="profiles",
+    help="Directory for CPU and memory profiles, toggled with SIGUSR1 (SIGUSR2 takes a memory snapshot) or /profile",
+)
+
+parser.add_argument(
+    "--brain_server",
+    env_var="CB_BRAIN_SERVER",
+    required=False,
+    help="Use the shared brain served by brain_server.py at this address (unix:/path/to.sock or host:port) instead of loading one",
+)
+
+parser.add_argument(
+    "--brain_replica",
+    env_var="CB_BRAIN_REPLICA",
+    required=False,
+    action="store_true",
+    help="With --brain_server, also load --brain locally and keep it in step with the server, so replies are generated without a round trip",
+)
+
 args = parser.parse_args()
 
 discord_token = args.discord_token
 slack_bot_token = args.slack_bot_token
 slack_app_token = args.slack_app_token
-user_map = args.user_map
 bot_name = args.name
 
-emoji_map_file = args.emoji_map_file
-emoji_map_active = emoji_map_file is not None and emoji_map_file != ''
+if discord_token and args.guild_id is None:
+    parser.error("--guild_id is required when a discord token is configured")
+if not args.brain_server and not (args.brain and args.output):
+    parser.error("--brain and --output are required unless --brain_server is given")
+if args.brain_replica and not (args.brain_server and args.brain):
+    parser.error("--brain_replica needs --brain_server and --brain")
+
+startup_timer = StartupTimer(_started)
+startup_timer.record("imports", perf_counter() - _started)
+
+profiler = Profiler(args.profile_dir)
+
+# the brain is loaded in a worker thread while the gateways connect; set once it's ready.
+# with --brain_server, brain_client talks to the shared brain and brain is only set if it has a local replica
+brain: Optional[Markov] = None
+brain_client: Optional[BrainClient] = None
+graph_pruner: Optional[GraphPruner] = None
+brain_ready: Optional[asyncio.Event] = None
+# the current brain's response pool and pruner tasks
+brain_tasks: List[asyncio.Task] = list()
+# set when the bot has to stop because of an error, rather than being interrupted
+exit_code = 0
+
+
+def load_brain(output: Optional[str]) -> Markov:
+    """Build the brain and its helpers. Runs off the event loop, so it mustn't touch anything on it."""
+    global graph_pruner
+    # the brain server doesn't replicate its pruning, so a replica keeps to its own budget
+    new_brain, graph_pruner = build_brain(args, output)
+    return new_brain
+
+
+def start_brain_tasks():
+    """Start the current brain's background work, stopping any left over from the brain it replaced"""
+    for task in brain_tasks:
+        task.cancel()
+    brain_tasks.clear()
+    if brain is not None and brain.response_pool is not None:
+        brain_tasks.append(asyncio.create_task(brain.response_pool.run()))
+    if graph_pruner:
+        brain_tasks.append(asyncio.create_task(graph_pruner.run(args.prune_interval)))
+
+
+async def reload_replica() -> Markov:
+    """Load the replica again from --brain, after the brain server restarted without what it had learned"""
+    global brain
+    brain = await asyncio.get_running_loop().run_in_executor(None, load_brain, None)
+    start_brain_tasks()
+    return brain
+
+
+def load_brain_timed(output: Optional[str]) -> Tuple[Markov, float]:
+    """load_brain, plus when it finished; the loop may be busy importing adapters and only see it later"""
+    loaded = load_brain(output)
+    return loaded, perf_counter()
+
+
+async def start_brain():
+    global brain, brain_client, exit_code
+    startup_timer.begin("brain load")
+    loaded_at = None
+    try:
+        if args.brain_replica:
+            brain, _ = await asyncio.get_running_loop().run_in_executor(None, load_brain_timed, None)
+        elif not args.brain_server:
+            brain, loaded_at = await asyncio.get_running_loop().run_in_executor(None, load_brain_timed, args.output)
+    except Exception:
+        # nothing can be answered without a brain, so stop instead of leaving mentions waiting on brain_ready
+        logging.exception("Failed to load the brain")
+        exit_code = 1
+        asyncio.get_running_loop().stop()
+        return
+
+    if args.brain_server:
+        brain_client = BrainClient(args.brain_server, replica=brain, reload_replica=reload_replica)
+
+        def on_connect():
+            startup_timer.end("brain load")
+            brain_ready.set()
+        asyncio.create_task(brain_client.run(on_connect=on_connect))
+    else:
+        startup_timer.end("brain load", loaded_at)
+        brain_ready.set()
+
+    start_brain_tasks()
 
-main_guild_id:int = args.guild_id
-extra_guild_ids:List[int] = args.extra_guild_ids if args.extra_guild_ids is not None else list()
-all_guild_objects:List[discord.Object] = [discord.Object(id=i) for i in ([main_guild_id] + extra_guild_ids)]
-
-brain = Markov(args.brain, args.output, args.user_map, [bot_name])
-
-intents = discord.Intents(guild_messages=True, message_content=True)
-discord_client: discord.Client = None
-
-def rotate_brain(the_brain: str, output: str):
-    brain_backup = "{}.{}".format(the_brain, time())
-    shutil.move(the_brain, brain_backup)
-    shutil.move(output, the_brain)
 
 def sanitize_and_tokenize(msg: str) -> list[str]:
     msg_tokens = msg.split()
@@ -142,306 +237,145 @@ def sanitize_and_tokenize(msg: str) -> list[str]:
         msg_tokens[i] = msg_tokens[i].strip("'\"!@#$%^&*().,/\\+=<>?:;").upper()
     return msg_tokens
 
-my_emoji_config: emoji_config.EmojiConfig = emoji_config.read_emoji_config(emoji_map_file)
-custom_emoji_cache: CustomEmojiCache = CustomEmojiCache()
+async def brain_response(prompt: str = "", learn: bool = False, slack: bool = False) -> str:
+    if brain_client is not None:
+        return await brain_client.create_response(prompt, learn=learn, slack=slack)
+    return brain.create_response(prompt, learn=learn, slack=slack)
 
-def get_ten(is_slack) -> str:
+async def get_ten(is_slack) -> str:
+    # gathered so that against a brain server the requests are pipelined rather than sent one at a time
+    responses = await asyncio.gather(*(brain_response(slack=is_slack) for i in range(0, 9)))
     response = ""
-    for i in range(0, 9):
-        response += brain.create_response(slack=is_slack)
+    for r in responses:
+        response += r
         response += "\n"
     return response
 
-#**********************< SLACK & DISCORD STUFF>**************************#
-if discord_token:
-    discord_client = commands.Bot(command_prefix='?', intents=intents)
-    tree = discord_client.tree
-else:
-    discord_client = None
-
-if discord_client:
-    @discord_client.event
-    async def on_ready():
-        for g in discord_client.guilds:
-            print(f'Starting sync for guild {g.id}...')
-            await tree.sync(guild=g)
-            print(f'Synced for guild {g.id}')
-
-        print("Logged in as {0.user}".format(discord_client))
-
-    @discord_client.event
-    async def on_message(message:discord.Message):
-        if message.author == discord_client.user:
-            return
-
-        bot_display_names = [discord_client.user.display_name]
-
-        mentioned = False
-        for mention in message.mentions:
-            if mention.id == discord_client.user.id:
-                mentioned = True
-                break
-
-        await try_append_emoji_to_message(message)
-
-        # print(f"Discord message from {message.author}: {message.content}")
-        response = create_raw_response(message.content, False, force_mention=mentioned, other_bot_names=bot_display_names)
-        if response and response.strip() != "":
-            await message.channel.send(response)
-
-
-    @tree.command(
-        name="add_react",
-        description="Add a reaction emoji config",
-        guilds=all_guild_objects
-    )
-    @app_commands.describe(regex_str='The regex against which each token will be checked (case insensitive)',
-                           emoji_str="The emoji string (either a single unicode character or an emoji's name) to react with")
-    @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
-    async def add_react(ctx: discord.Interaction, regex_str: str, emoji_str: str):
-
-        if not await get_user_has_role_for_interaction(ctx, 'admin'):
-            await ctx.response.send_message('Missing permissions for this command')
-            return
-
-        def is_valid_str_arg(arg: str) -> bool:
-            if arg is None or arg == '':
-                return False
-            return True
-
-        if not is_valid_str_arg(regex_str):
-            await ctx.response.send_message(f'Failed to add emoji since regex \"{regex_str}\" is invalid')
-            return
-
-        if not is_valid_str_arg(emoji_str):
-            await ctx.response.send_message(f'Failed to add emoji since emoji \"{emoji_str}\" is invalid')
-            return
-
-        existing_emoji_mapping = my_emoji_config.find_mapping_via_regex_str(regex_str, ctx.guild_id)
-        if existing_emoji_mapping is not None:
-            await ctx.response.send_message(f'Failed to add emoji since regex \"{regex_str}\" already in config')
-            return
-
-        def try_get_regex_pattern(regex_str:str) -> Optional[re.Pattern]:
-            try:
-                pattern = re.compile(regex_str)
-                return pattern
-            except:
-                return None
-
-        new_pattern = try_get_regex_pattern(regex_str)
-        if new_pattern is None:
-            await ctx.response.send_message(f'Failed to add emoji since regex \"{regex_str}\" is invalid')
-            return
-
-        if len(emoji_str) >= 2:
-            custom_emoji = await custom_emoji_cache.find_custom_emoji_with_name(ctx.guild, emoji_str, force_refresh_emoji=True)
-            if custom_emoji is None:
-                msg = f"Failed to add emoji. Couldn't find emoji \"{emoji_str}\""
-                print(msg)
-                await ctx.response.send_message(msg)
-                return
-
-        my_emoji_config.add_mapping(EmojiMapping(regex_str, emoji_str, ctx.guild_id))
-
-        if emoji_map_active:
-            emoji_config.write_emoji_config(emoji_map_file, my_emoji_config)
-        await ctx.response.send_message('Added emoji response')
-
-    @tree.command(
-        name="remove_react",
-        description="Remove a reaction emoji config",
-        guilds=all_guild_objects
-    )
-    @app_commands.describe(regex_str='The regex against which each token will be checked (case insensitive)')
-    @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
-    async def remove_react(ctx:discord.Interaction, regex_str:str):
-
-        if not await get_user_has_role_for_interaction(ctx, 'admin'):
-            await ctx.response.send_message('Missing permissions for this command')
-            return
-
-        def is_valid_str_arg(arg:str)->bool:
-            if arg is None or arg == '':
-                return False
-            return True
-
-        if not is_valid_str_arg(regex_str):
-            await ctx.response.send_message(f'Failed to remove emoji since regex \"{regex_str}\" is invalid')
-            return
-
-        removed = my_emoji_config.remove_mappings_for_regex(regex_str, ctx.guild_id)
-        if removed > 0:
-            if emoji_map_active:
-                emoji_config.write_emoji_config(emoji_map_file, my_emoji_config)
-            await ctx.response.send_message(f'Removed emoji react for regex \"{regex_str}\"')
-        else:
-            await ctx.response.send_message(f'Nothing to remove for regex \"{regex_str}\"')
-
 
-    @tree.command(
-        name="list_react",
-        description="List emoji reactions",
-        guilds=all_guild_objects
-    )
-    @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
-    async def list_react(ctx: discord.Interaction):
-
-        if not await get_user_has_role_for_interaction(ctx, 'admin'):
-            await ctx.response.send_message('Missing permissions for this command')
-            return
-
-        reply_content = 'Emoji:\n'
-        for emoji_mapping in my_emoji_config.emoji_config_list:
-            reply_content += f'{emoji_mapping.regex_str} => {emoji_mapping.emoji_str}\n'
-        await ctx.response.send_message(reply_content)
-
-    @tree.command(
-        name="force_sync",
-        description="Force Sync the bot",
-        guilds=all_guild_objects
-    )
-    @app_commands.checks.cooldown(3, 20, key=lambda i: (i.guild_id, i.user.id))
-    async def force_sync(ctx: discord.Interaction):
-
-        if not await get_user_has_role_for_interaction(ctx, 'admin'):
-            await ctx.response.send_message('Missing permissions for this command')
-            return
-
-        await ctx.response.defer()
-        print(f'Starting sync for guild {ctx.guild.id}...')
-        await tree.sync(guild=ctx.guild)
-        print(f'Synced for guild {ctx.guild.id}')
-        await ctx.followup.send('Forcibly synced')
-
-
-    async def get_user_has_role_for_interaction(ctx: discord.Interaction, role_name: str) -> bool:
-        """For some reason I couldn't get app_commands.checks.has_role working. Something is missing in the discordpy
-        cache. Since we're using this for really low frequency operations, I just refetch everything here to do
-        checks solidly."""
-        guild = await discord_client.fetch_guild(ctx.guild_id)
-
-        if guild is None:
-            return False
-
-        user: discord.Member = await guild.fetch_member(ctx.user.id)
-
-        if user is None:
-            return False
-
-        guild_roles = await guild.fetch_roles()
-
-        found_role = None
-        for r in guild_roles:
-            if r.name.lower() == role_name.lower():
-                found_role = r
-                break
-
-        if found_role is None:
-            return False
-
-        # For some reason, ctx.user.get_role doesn't work here because ctx.guild has an empty roles dictionary?
-        user_role = user.get_role(found_role.id)
-        return user_role is not None
-
-    async def try_append_emoji_to_message(message:discord.Message):
-        msg_tokens = sanitize_and_tokenize(message.content)
-        reaction_count = 0
-        max_reaction_count = 5
-        for token in msg_tokens:
-            configured_reaction_emoji = my_emoji_config.find_emoji_for_message_token(token, message.guild.id)
-            if configured_reaction_emoji is None:
-                continue
-
-            custom_emoji = await custom_emoji_cache.find_custom_emoji_with_name(message.guild, configured_reaction_emoji.emoji_str)
-
-            if custom_emoji is not None:
-                await message.add_reaction(custom_emoji)
-                reaction_count += 1
-            else:
-                try:
-                    await message.add_reaction(configured_reaction_emoji.emoji_str)
-                    reaction_count += 1
-                except:
-                    print(f'Failed to add emoji for {configured_reaction_emoji}')
-
-            if reaction_count >= max_reaction_count:
-                break
-
-
-if slack_bot_token:
-    app = AsyncApp(token=slack_bot_token)
-else:
-    app = None
-if app:
-    @app.event("message")
-    async def handle_slack_message(payload):
-        response = create_raw_response(payload["text"], True)
-        if response and response.strip() != "":
-            await app.client.chat_postMessage(channel=payload["channel"], text=response)
-
-    slack_socket_client = AsyncSocketModeHandler(app, slack_app_token)
-
-    async def run_slack_app():
-        await slack_socket_client.connect_async()
-#**********************</SLACK & DISCORD STUFF>**************************#
-
-
-def create_raw_response(
+async def create_raw_response(
         incoming_message: str,
         is_slack: bool,
         force_mention: bool = False,
         other_bot_names: Optional[List[str]] = None
 ):
     msg_tokens = sanitize_and_tokenize(incoming_message)
+    other_bot_names = other_bot_names if other_bot_names is not None else list()
     mentioned = force_mention or any([n.upper() in msg_tokens for n in other_bot_names + [bot_name]])
     if mentioned or "TOWN" in msg_tokens:  # it's not _not_ a bug
+        await brain_ready.wait()
         if "GETGET10" in msg_tokens:
-            return get_ten(is_slack)
+            return await get_ten(is_slack)
         else:
-            return brain.create_response(incoming_message, learn=True, slack=is_slack)
+            return await brain_response(incoming_message, learn=True, slack=is_slack)
+
 
-# TODO: the local server should probably be a class and should probably be
-# multi-threaded to handle simultaneous connections ... but this is expedient
-# for quick local testing without Slack/Discord integration
-#
 # this will listen on a local server, if a port is specified.
 # try connecting with netcat or something, like nc localhost <your port>
-def run_local_server(port_num):
-    host = "localhost"
-    port = port_num
+async def handle_local_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     prompt = "\nSay something: "
-    print("Listening on port: " + str(port))
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((host, port))
-        s.listen(1)
-        conn, addr = s.accept()
-        with conn:
-            print("Connection recieved from", addr)
-            while True:
-                conn.sendall(str.encode(prompt))
-                data = conn.recv(1024)
-                if not data:
-                    break
-                decoded_data = data.decode("utf-8")
-                response = create_raw_response(decoded_data, False)
-                if response:
-                    response = bot_name + " " + "said: " + response
-                    conn.sendall(str.encode(response))
+    print("Connection recieved from", writer.get_extra_info("peername"))
+    try:
+        while True:
+            writer.write(str.encode(prompt))
+            await writer.drain()
+            data = await reader.read(1024)
+            if not data:
+                break
+            decoded_data = data.decode("utf-8")
+            response = await create_raw_response(decoded_data, False)
+            if response:
+                response = bot_name + " " + "said: " + response
+                writer.write(str.encode(response))
+    except asyncio.CancelledError:
+        # shutting down; finishing quietly keeps asyncio's stream callback from logging the cancellation
+        pass
+    finally:
+        writer.close()
+
+async def run_local_server(port_num):
+    server = await asyncio.start_server(handle_local_connection, "localhost", port_num, reuse_address=True)
+    print("Listening on port: " + str(port_num))
+    async with server:
+        await server.serve_forever()
+
+
+def create_discord_client():
+    # discord.py, slack_bolt and aiohttp are only imported when they're configured; they dominate import time
+    with startup_timer.phase("discord import"):
+        from discord_adapter import CodeBroDiscordBot
+    extra_guild_ids: List[int] = args.extra_guild_ids if args.extra_guild_ids is not None else list()
+    return CodeBroDiscordBot(
+        create_raw_response,
+        sanitize_and_tokenize,
+        [args.guild_id] + extra_guild_ids,
+        args.emoji_map_file,
+        on_first_ready=lambda: startup_timer.end("discord connect"),
+        profiler=profiler,
+    )
+
+
+def create_slack_adapter():
+    with startup_timer.phase("slack import"):
+        from slack_adapter import SlackAdapter
+    return SlackAdapter(slack_bot_token, slack_app_token, create_raw_response)
+
+
+async def start_slack(slack_adapter):
+    await slack_adapter.start()
+    startup_timer.end("slack connect")
+
+
+async def log_outbound_stats(queues, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        for queue in queues:
+            logging.info(f'Outbound {queue.name}: {queue.stats()}')
+
+
+async def start_bot():
+    """Kick off the brain load and whichever front-ends are configured, all overlapping on the loop"""
+    global brain_ready, discord_client
+    brain_ready = asyncio.Event()
+    profiler.install_signal_handlers(asyncio.get_running_loop())
+
+    asyncio.create_task(start_brain())
+    # let start_brain hand the load to the executor before the adapter imports below tie up the loop
+    await asyncio.sleep(0)
+    if args.local_server_port:
+        asyncio.create_task(run_local_server(args.local_server_port))
+    outbound_queues = list()
+    if slack_bot_token:
+        slack_adapter = create_slack_adapter()
+        outbound_queues.append(slack_adapter.outbound)
+        startup_timer.begin("slack connect")
+        asyncio.create_task(start_slack(slack_adapter))
+    if discord_token:
+        discord_client = create_discord_client()
+        outbound_queues.append(discord_client.outbound)
+        startup_timer.begin("discord connect")
+        asyncio.create_task(discord_client.start(discord_token))
+    if outbound_queues and args.outbound_stats_interval > 0:
+        asyncio.create_task(log_outbound_stats(outbound_queues, args.outbound_stats_interval))
+    startup_timer.arm()
+
 
 # MAIN ----
-basic_loop = asyncio.get_event_loop()
+basic_loop = asyncio.new_event_loop()
+asyncio.set_event_loop(basic_loop)
+discord_client = None
 try:
-    if args.local_server_port:
-        run_local_server(port_num=args.local_server_port)
-    if app:
-        basic_loop.create_task(run_slack_app())
-    if discord_client:
-        basic_loop.create_task(discord_client.start(discord_token)),
+    basic_loop.run_until_complete(start_bot())
     basic_loop.run_forever()
 except KeyboardInterrupt:
-    if args.rotate:
+    if args.rotate and not args.brain_server:
         rotate_brain(args.brain, args.output)
 finally:
+    pending_tasks = asyncio.all_tasks(basic_loop)
+    for task in pending_tasks:
+        task.cancel()
+    basic_loop.run_until_complete(asyncio.gather(*pending_tasks, return_exceptions=True))
+    profiler.stop()
+    if discord_client is not None and discord_client.emoji_config_writer:
+        discord_client.emoji_config_writer.flush()
     basic_loop.close()
+sys.exit(exit_code)
@@ -1,6 +1,10 @@
 import random
+import shutil
+import sys
 import yaml
-from itertools import chain, groupby
+from itertools import groupby
+from time import time
+from typing import Optional
 
 START_TOK = "<START>"
 STOP_TOK = "<STOP>"
@@ -8,15 +12,67 @@ STOP_TOK = "<STOP>"
 STOP = object()
 START = object()
 
+class _Node:
+    """
+    One context in the trie: the path of tokens from the root to a node is the context it stands for,
+    so contexts that share a prefix share the nodes for it.
+
+    next_words holds the transitions seen out of this context (for random.choice) and stats maps each
+    of them to its [count, last_seen]; both are None for contexts only ever seen as a prefix.
+    exit_word/exit_dist are the transition that reaches STOP in the fewest steps and that number of
+    steps, and refs counts the transitions that lead into this context.
+    """
+    __slots__ = ('children', 'next_words', 'stats', 'exit_word', 'exit_dist', 'refs')
+
+    def __init__(self):
+        self.children = None
+        self.next_words = None
+        self.stats = None
+        self.exit_word = None
+        self.exit_dist = 0
+        self.refs = 0
+
+
+# Memory estimates, calibrated against tracemalloc with bench_markov.py. On brains of 100k+ transitions they come
+# within about 4% of the real size at orders 1-4 (under at order 1, over above it); on tiny ones with a handful of
+# distinct words they overestimate by up to a third, since the words' strings are shared far more than assumed.
+
+# a str-keyed dict holds up to 5 entries before it first grows
+_SMALL_DICT_BYTES = sys.getsizeof({'': None})
+# each entry of a dict past that, averaged over its growth (24 byte entries kept at most 2/3 full, plus the index)
+_DICT_ENTRY_BYTES = 36
+# a node, plus its share of its parent's children dict (most nodes are in small ones at higher orders)
+_NODE_BYTES = sys.getsizeof(_Node()) + 16
+# the children dict of a node that has any
+_BRANCH_BYTES = _SMALL_DICT_BYTES
+# the next_words list and stats dict of a context with transitions
+_CONTEXT_BYTES = sys.getsizeof([]) + _SMALL_DICT_BYTES
+# a list slot, a stats entry and its [count, last_seen], and the word's str: tokens aren't interned, so a new
+# transition usually holds on to its own copy
+_TRANSITION_BYTES = 8 + _DICT_ENTRY_BYTES + sys.getsizeof([0, 0.0]) + sys.getsizeof('')
+
+
+def rotate_brain(the_brain: str, output: str):
+    """Back up the brain and replace it with the corpus learned so far"""
+    brain_backup = "{}.{}".format(the_brain, time())
+    shutil.move(the_brain, brain_backup)
+    shutil.move(output, the_brain)
+
 
 # instantiate a Markov object with the source file
 class Markov:
-    def __init__(self, input_file: str, output_file: str, user_map, ignore_words):
+    def __init__(self, input_file: str, output_file: Optional[str], user_map, ignore_words, order: int = 2):
         if input_file == output_file:
             raise ValueError("input and output files must be different")
+        if order < 1:
+            raise ValueError("order must be at least 1")
+        # number of preceding tokens each transition is conditioned on
+        self.order = order
         self.user_map = self._init_user_map(user_map)
         self.ignore_words = set(w.upper() for w in ignore_words)
         self.output_file = output_file
+        # optional ResponsePool that unseeded/hot-seed responses are drawn from
+        self.response_pool = None
         self.update_graph_and_corpus(self.corpus_iter(input_file), init=True)
 
     def corpus_iter(self, source_file: str):
@@ -35,21 +91,19 @@ class Markov:
                     yield from self.tokenize(line)
 
     @classmethod
-    def triples_and_stop(cls, words):
+    def contexts_and_stop(cls, words, order: int):
         """
-        Emit 3-grams from the sequence of words, the last one ending with the
-        special STOP token
+        Emit (context, next_word) pairs from the sequence of words, where context is the
+        up-to-order tokens before next_word. The sequence is framed by the special START
+        and STOP tokens, so early contexts start with START and the last next_word is STOP.
+        Sequences of fewer than two words have no transitions between words and emit nothing.
         """
-        words = chain(words, [STOP])
-        try:
-            w1 = next(words)
-            w2 = next(words)
-            w3 = next(words)
-            while True:
-                yield (w1, w2, w3)
-                w1, w2, w3 = w2, w3, next(words)
-        except StopIteration:
+        words = list(words)
+        if len(words) < 2:
             return
+        tokens = [START] + words + [STOP]
+        for i in range(1, len(tokens)):
+            yield tuple(tokens[max(0, i - order):i]), tokens[i]
 
     def _ignore(self, word: str):
         return word.strip("\'\"!@#$%^&*().,/\\+=<>?:;").upper() in self.ignore_words
@@ -77,41 +131,206 @@ class Markov:
 
     def _update_graph_and_emit_changes(self, token_seqs, init=False):
         """
-        self.graph stores the graph of n-gram trasitions.
-        The keys are single tokens or pairs and the values possible next words in the n-gram.
-        Initial tokens are also specially added to the list at the key START.
+        self.trie stores the n-gram transitions as a trie of contexts (see _Node), so
+        raising the order only adds the nodes for the extra tokens rather than whole new
+        keys. Contexts are up to self.order tokens long, and phrases are framed by START,
+        so the first words of a phrase are found under the context (START,).
 
         _update_graph_and_emit_changes returns a generator that when run will
-        update the graph with the ngrams taken from each element of token_seqs.
+        update the trie with the ngrams taken from each element of token_seqs.
 
         Yields the token sequence that result in updates so they can be further
         acted on.
 
+        self.generation counts the learned sequences, so anything derived from the graph
+        (e.g. pooled responses) can tell how out of date it is. self.pruned counts the
+        transitions forgotten by prune_edge, so it can also tell when it may lead somewhere
+        the graph no longer goes.
+
+        Every transition keeps a [count, last_seen] pair so rare or stale ones can be
+        pruned when the graph outgrows its budget (see graph_pruner.py).
+
         if init is True reinitialize from an empty graph
         """
         if init:
-            self.graph = {START: []}
+            self.trie = _Node()
+            self.generation = 0
+            self.pruned = 0
+            self.node_count = 0
+            # nodes with a children dict
+            self.branch_count = 0
+            self.context_count = 0
+            self.edge_count = 0
+            self._start = self._node_for((START,), create=True)
 
         for seq in token_seqs:
-            first = True
+            now = time()
             learned = False
-            for w1, w2, w3 in self.triples_and_stop(seq):
-                if first:
-                    if w1 not in self.graph[START]:
-                        self.graph[START].append(w1)
-                        learned = True
-                    next_words = self.graph.setdefault(w1, [])
-                    if w2 not in next_words:
-                        next_words.append(w2)
-                        learned = True
-                    first = False
-                next_words = self.graph.setdefault((w1, w2), [])
-                if w3 not in next_words:
-                    next_words.append(w3)
-                    learned = True
+            path = []
+            for context, next_word in self.contexts_and_stop(seq, self.order):
+                learned |= self._add_edge(context, next_word, now)
+                if context != (START,):
+                    path.append((context, next_word))
+            self._update_exit_edges(path)
             if learned:
+                self.generation += 1
                 yield seq
 
+    @property
+    def approx_bytes(self) -> int:
+        return (self.node_count * _NODE_BYTES + self.branch_count * _BRANCH_BYTES
+                + self.context_count * _CONTEXT_BYTES + self.edge_count * _TRANSITION_BYTES)
+
+    def _node_for(self, context, create=False) -> Optional[_Node]:
+        node = self.trie
+        for token in context:
+            children = node.children
+            child = children.get(token) if children is not None else None
+            if child is None:
+                if not create:
+                    return None
+                if children is None:
+                    children = node.children = {}
+                    self.branch_count += 1
+                child = children[token] = _Node()
+                self.node_count += 1
+            node = child
+        return node
+
+    def _edge_target(self, context, next_word):
+        """The context the walk moves to after following context -> next_word, or None at the end of a phrase"""
+        if next_word is STOP:
+            return None
+        return (context + (next_word,))[-self.order:]
+
+    def _add_edge(self, context, next_word, now: float) -> bool:
+        """Count one occurrence of context -> next_word, returning True if the transition is new"""
+        node = self._node_for(context, create=True)
+        if node.stats is None:
+            node.next_words = []
+            node.stats = {}
+            self.context_count += 1
+        stats = node.stats.get(next_word)
+        if stats is not None:
+            stats[0] += 1
+            stats[1] = now
+            return False
+
+        node.next_words.append(next_word)
+        node.stats[next_word] = [1, now]
+        self.edge_count += 1
+
+        target = self._edge_target(context, next_word)
+        if target is not None:
+            self._node_for(target, create=True).refs += 1
+        return True
+
+    def _update_exit_edges(self, path):
+        """
+        Each context remembers the transition that reaches STOP in the fewest steps,
+        along with that number of steps. Walking a phrase backwards from its end can only
+        shorten those distances. The pruner never removes an exit edge, and an exit edge
+        always leads to a context strictly closer to STOP, so every context keeps a path out.
+        """
+        dist = 0
+        for context, next_word in reversed(path):
+            target = self._edge_target(context, next_word)
+            if target is not None:
+                dist = self._node_for(target).exit_dist
+            dist += 1
+            node = self._node_for(context)
+            if node.exit_word is None or dist < node.exit_dist:
+                node.exit_word = next_word
+                node.exit_dist = dist
+
+    def prunable_keys(self):
+        """Snapshot of the contexts whose transitions may be pruned (everything but (START,))"""
+        keys = []
+        stack = [((), self.trie)]
+        while stack:
+            context, node = stack.pop()
+            if node.next_words and context != (START,):
+                keys.append(context)
+            if node.children:
+                stack.extend((context + (token,), child) for token, child in node.children.items())
+        return keys
+
+    def edges_from(self, key):
+        """Emit (next_word, count, last_seen) for each transition out of the context key"""
+        node = self._node_for(key)
+        if node is None or node.stats is None:
+            return
+        for next_word in node.next_words:
+            count, last_seen = node.stats[next_word]
+            yield next_word, count, last_seen
+
+    def can_prune(self, key, next_word) -> bool:
+        """Whether prune_edge would forget key -> next_word rather than refuse to"""
+        if key == (START,):
+            return False
+        node = self._node_for(key)
+        if node is None or node.stats is None or len(node.next_words) < 2:
+            return False
+        return next_word in node.stats and node.exit_word != next_word
+
+    def prune_edge(self, key, next_word):
+        """
+        Forget the transition key -> next_word, unless it is the context's last way out or
+        its shortest path to STOP. Contexts that are no longer reachable from any transition
+        are dropped along with their own transitions.
+
+        Returns (edges_removed, keys_removed, approx_bytes_reclaimed).
+        """
+        if not self.can_prune(key, next_word):
+            return 0, 0, 0
+
+        node = self._node_for(key)
+        bytes_before = self.approx_bytes
+        node.next_words.remove(next_word)
+        del node.stats[next_word]
+        self.edge_count -= 1
+        edges_removed, keys_removed = 1, 0
+
+        orphans = [self._edge_target(key, next_word)]
+        while orphans:
+            target = orphans.pop()
+            if target is None:
+                continue
+            target_node = self._node_for(target)
+            target_node.refs -= 1
+            if target_node.refs > 0:
+                continue
+            for orphan_next in target_node.next_words or ():
+                edges_removed += 1
+                orphans.append(self._edge_target(target, orphan_next))
+            self.edge_count -= len(target_node.next_words or ())
+            self._remove_context(target)
+            keys_removed += 1
+
+        self.pruned += edges_removed
+        return edges_removed, keys_removed, bytes_before - self.approx_bytes
+
+    def _remove_context(self, context):
+        """Drop a context's transitions, and then any nodes left with neither transitions nor children"""
+        nodes = [self.trie]
+        for token in context:
+            nodes.append(nodes[-1].children[token])
+        node = nodes[-1]
+        if node.stats is not None:
+            node.next_words = node.stats = node.exit_word = None
+            self.context_count -= 1
+
+        for depth in range(len(context), 0, -1):
+            node = nodes[depth]
+            if node.children or node.stats is not None or node.refs > 0:
+                break
+            parent = nodes[depth - 1]
+            del parent.children[context[depth - 1]]
+            if not parent.children:
+                parent.children = None
+                self.branch_count -= 1
+            self.node_count -= 1
+
     def _init_user_map(self, mapfile):
         if mapfile:
             with open(mapfile, 'r', encoding='utf8') as infile:
@@ -123,25 +342,47 @@ class Markov:
         self.update_corpus(changes, init=init)
 
     def update_corpus(self, token_seqs, init=False):
+        if self.output_file is None:
+            # read replicas (see brain_server.py) learn without keeping a corpus of their own
+            for _ in token_seqs:
+                pass
+            return
         mode = 'w' if init else 'a'
         with open(self.output_file, mode, encoding='utf8') as f:
             for seq in token_seqs:
                 f.write(" ".join(seq))
                 f.write("\n")
 
+    def is_seed(self, word) -> bool:
+        """Whether generation can start from word: it has been seen at the start of a sentence"""
+        return word in (self._start.stats or ())
+
+    def _next_word(self, context):
+        """
+        Pick the word after context. A context never seen with transitions of its own backs off
+        to its longest suffix that was, the way an n-gram model falls back to a lower order.
+        """
+        while context:
+            node = self._node_for(context)
+            if node is not None and node.next_words:
+                return random.choice(node.next_words)
+            context = context[1:]
+        return STOP
+
     def generate_markov_text(self, seed=None):
-        if seed and seed in self.graph:
-            w1 = seed
+        if seed and self.is_seed(seed):
+            gen_words = [seed]
+            context = (START, seed)[-self.order:]
         else:
-            w1 = random.choice(self.graph[START])
-        w2 = random.choice(self.graph[w1])
+            gen_words = []
+            context = (START,)
 
-        gen_words = [w1]
         while True:
-            if w2 == STOP:
+            next_word = self._next_word(context)
+            if next_word is STOP:
                 break
-            w1, w2 = w2, random.choice(self.graph[(w1, w2)])
-            gen_words.append(w1)
+            gen_words.append(next_word)
+            context = (context + (next_word,))[-self.order:]
 
         message = ' '.join(gen_words)
         return message
@@ -161,9 +402,12 @@ class Markov:
     def create_response(self, prompt="", learn=False, slack=False):
         # set seedword from somewhere in words if there's no prompt
         prompt_tokens = prompt.split()
-        valid_seeds = [tok for tok in prompt_tokens[:-2] if tok in self.graph]
+        valid_seeds = [tok for tok in prompt_tokens[:-2] if self.is_seed(tok)]
         seed_word = random.choice(valid_seeds) if valid_seeds else None
-        response = self.generate_markov_text(seed_word)
+        if self.response_pool is not None:
+            response = self.response_pool.take(seed_word)
+        else:
+            response = self.generate_markov_text(seed_word)
         if learn:
             self.update_graph_and_corpus(self.tokenize(prompt))
         return self._map_users(response, slack)
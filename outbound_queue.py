@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, NamedTuple
+
+
+def chunk_message(text: str, max_len: int) -> List[str]:
+    """Split text into pieces no longer than max_len, breaking between lines where possible"""
+    chunks = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > max_len:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:max_len])
+            line = line[max_len:]
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= max_len:
+            current += '\n' + line
+        else:
+            chunks.append(current)
+            current = line
+    if current.strip() != '':
+        chunks.append(current)
+    return [c for c in chunks if c.strip() != '']
+
+
+class TokenBucket:
+    """Allows `rate` sends per second on average, with bursts of up to `burst`"""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    def take(self) -> float:
+        """Take a token, returning how many seconds to wait before the send it pays for"""
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class _Outgoing:
+    __slots__ = ('text', 'enqueued')
+
+    def __init__(self, text: str, enqueued: float):
+        self.text = text
+        self.enqueued = enqueued
+
+
+class _Channel:
+    __slots__ = ('target', 'bucket', 'pending', 'worker')
+
+    def __init__(self, target: Any, bucket: TokenBucket):
+        self.target = target
+        self.bucket = bucket
+        self.pending: Deque[_Outgoing] = deque()
+        self.worker = None
+
+
+class OutboundStats(NamedTuple):
+    depth: int
+    busiest_channel_depth: int
+    sent: int
+    coalesced: int
+    dropped: int
+    failed: int
+    avg_latency: float
+    max_latency: float
+
+    def __str__(self):
+        return (f'depth {self.depth} (busiest channel {self.busiest_channel_depth}), sent {self.sent}, '
+                f'coalesced {self.coalesced}, dropped {self.dropped}, failed {self.failed}, '
+                f'latency avg {self.avg_latency:.2f}s max {self.max_latency:.2f}s')
+
+
+class OutboundQueue:
+    """Per-channel outbound message queue shared by the Slack and Discord front-ends.
+
+    Each channel gets a token bucket and a queue of at most max_depth messages, drained by its own task. Replies are
+    chunked to max_message_len. When a channel's queue is full, a new chunk is merged into the newest queued message
+    if the result still fits, otherwise the oldest queued message is dropped: in a burst, the stalest reply is the one
+    nobody will miss."""
+    def __init__(
+            self,
+            name: str,
+            send: Callable[[Any, str], Awaitable[Any]],
+            max_message_len: int,
+            rate: float = 1.0,
+            burst: int = 3,
+            max_depth: int = 10
+    ):
+        self.name = name
+        self.send = send
+        self.max_message_len = max_message_len
+        self.rate = rate
+        self.burst = burst
+        self.max_depth = max_depth
+
+        self._channels: Dict[Hashable, _Channel] = dict()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self._latency_total = 0.0
+        self._max_latency = 0.0
+
+    def enqueue(self, channel_key: Hashable, target: Any, text: str):
+        """Queue text for delivery to target, which is whatever `send` expects (a channel id, a channel object...)"""
+        channel = self._channels.get(channel_key)
+        if channel is None:
+            channel = self._channels[channel_key] = _Channel(target, TokenBucket(self.rate, self.burst))
+
+        now = monotonic()
+        for chunk in chunk_message(text, self.max_message_len):
+            if len(channel.pending) < self.max_depth:
+                channel.pending.append(_Outgoing(chunk, now))
+                continue
+
+            newest = channel.pending[-1]
+            if len(newest.text) + 1 + len(chunk) <= self.max_message_len:
+                newest.text += '\n' + chunk
+                self.coalesced += 1
+            else:
+                channel.pending.popleft()
+                channel.pending.append(_Outgoing(chunk, now))
+                self.dropped += 1
+
+        if channel.worker is None and channel.pending:
+            channel.worker = asyncio.create_task(self._drain(channel_key, channel))
+
+    async def _drain(self, channel_key: Hashable, channel: _Channel):
+        try:
+            while channel.pending:
+                delay = channel.bucket.take()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not channel.pending:
+                    break
+                outgoing = channel.pending.popleft()
+                try:
+                    await self.send(channel.target, outgoing.text)
+                except Exception as e:
+                    self.failed += 1
+                    logging.warning(f'{self.name}: failed to send to {channel_key}: {e}')
+                    continue
+                latency = monotonic() - outgoing.enqueued
+                self.sent += 1
+                self._latency_total += latency
+                self._max_latency = max(self._max_latency, latency)
+        finally:
+            channel.worker = None
+
+    def stats(self) -> OutboundStats:
+        depths = [len(c.pending) for c in self._channels.values()]
+        avg_latency = self._latency_total / self.sent if self.sent else 0.0
+        return OutboundStats(sum(depths), max(depths, default=0), self.sent, self.coalesced, self.dropped,
+                             self.failed, avg_latency, self._max_latency)
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from time import monotonic
+from typing import List, Optional, Tuple
+
+
+class Profiler:
+    """On-demand profiling for the running bot, toggled by signal or admin command.
+
+    While running, a background thread samples the main thread's stack every sample_interval seconds (so it sees the
+    event loop and everything it calls, Markov included) and tracemalloc records allocations. Stopping writes the
+    CPU samples as collapsed stacks (feed them to flamegraph.pl or speedscope) plus a summary. Memory snapshots can be
+    taken at any point while running; each one is written out along with a diff against the previous snapshot, which
+    is where growth of the brain's graph shows up. Nothing runs, and nothing is traced, while it's stopped.
+
+    On the event loop use the async variants, which only take the snapshot on the loop and leave filtering, diffing
+    and writing it (seconds, on a big brain) to a worker thread."""
+    _SNAPSHOT_FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    )
+
+    def __init__(self, output_dir: str, sample_interval: float = 0.005, trace_frames: int = 5):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.trace_frames = trace_frames
+
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._samples: Counter = Counter()
+        self._started_at = 0.0
+        self._last_snapshot: Optional[tracemalloc.Snapshot] = None
+        self._started_tracing = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self._samples = Counter()
+        self._last_snapshot = None
+        self._stop.clear()
+        self._started_at = monotonic()
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start(self.trace_frames)
+        self._thread = threading.Thread(target=self._sample, args=(threading.main_thread().ident,),
+                                        name='profiler', daemon=True)
+        self._thread.start()
+        logging.info('Profiler started')
+
+    def stop(self) -> List[str]:
+        """Stop sampling and tracing, returning the files written"""
+        if not self.running:
+            return list()
+        return self._write_stopped(*self._stop_capture())
+
+    async def stop_async(self) -> List[str]:
+        """Like stop, but writes the profiles in a worker thread so the event loop isn't held up"""
+        if not self.running:
+            return list()
+        captured = self._stop_capture()
+        return await asyncio.get_running_loop().run_in_executor(None, self._write_stopped, *captured)
+
+    def _stop_capture(self) -> Tuple[tuple, Counter, float]:
+        captured = self._capture_snapshot()
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if self._started_tracing:
+            tracemalloc.stop()
+        self._last_snapshot = None
+        return captured, self._samples, monotonic() - self._started_at
+
+    def _write_stopped(self, captured: tuple, samples: Counter, seconds: float) -> List[str]:
+        written = self._write_snapshot(*captured)
+        written += self._write_cpu_profile(samples, seconds)
+        logging.info(f'Profiler stopped, wrote {", ".join(written)}')
+        return written
+
+    def toggle(self) -> List[str]:
+        if self.running:
+            return self.stop()
+        self.start()
+        return list()
+
+    async def toggle_async(self) -> List[str]:
+        if self.running:
+            return await self.stop_async()
+        self.start()
+        return list()
+
+    def _sample(self, thread_id: int):
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self._samples[';'.join(reversed(stack))] += 1
+
+    def _path(self, kind: str, extension: str) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        return os.path.join(self.output_dir, f'{kind}-{stamp}.{extension}')
+
+    def _write_cpu_profile(self, samples: Counter, seconds: float) -> List[str]:
+        total = sum(samples.values())
+        collapsed_path = self._path('cpu', 'collapsed')
+        with open(collapsed_path, 'w', encoding='utf8') as outfile:
+            for stack, count in samples.most_common():
+                outfile.write(f'{stack} {count}\n')
+
+        # self time per frame, plus total time spent anywhere under markov.py
+        self_time: Counter = Counter()
+        markov_samples = 0
+        for stack, count in samples.items():
+            self_time[stack.rsplit(';', 1)[-1]] += count
+            if 'markov.py:' in stack:
+                markov_samples += count
+
+        summary_path = self._path('cpu', 'txt')
+        with open(summary_path, 'w', encoding='utf8') as outfile:
+            outfile.write(f'{total} samples over {seconds:.1f}s\n')
+            if total:
+                outfile.write(f'{100 * markov_samples / total:.1f}% of samples inside markov.py\n')
+            outfile.write('\nTop frames by self time:\n')
+            for frame, count in self_time.most_common(40):
+                outfile.write(f'{100 * count / total:6.2f}% {count:8d}  {frame}\n')
+        return [collapsed_path, summary_path]
+
+    def snapshot(self) -> List[str]:
+        """Write a memory snapshot, and its diff against the previous one, returning the files written"""
+        if not self.running:
+            return list()
+        return self._write_snapshot(*self._capture_snapshot())
+
+    async def snapshot_async(self) -> List[str]:
+        """Like snapshot, but analyses and writes it in a worker thread so the event loop isn't held up"""
+        if not self.running:
+            return list()
+        captured = self._capture_snapshot()
+        return await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot, *captured)
+
+    def _capture_snapshot(self) -> Tuple[tracemalloc.Snapshot, Optional[tracemalloc.Snapshot], int, int]:
+        """The part of a snapshot that has to happen now; filtering, comparing and writing it can wait"""
+        snapshot = tracemalloc.take_snapshot()
+        previous, self._last_snapshot = self._last_snapshot, snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return snapshot, previous, current, peak
+
+    def _write_snapshot(
+            self,
+            snapshot: tracemalloc.Snapshot,
+            previous: Optional[tracemalloc.Snapshot],
+            current: int,
+            peak: int
+    ) -> List[str]:
+        snapshot = snapshot.filter_traces(self._SNAPSHOT_FILTERS)
+        written = list()
+
+        snapshot_path = self._path('memory', 'txt')
+        with open(snapshot_path, 'w', encoding='utf8') as outfile:
+            outfile.write(f'traced {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB\n')
+            outfile.write('\nTop allocations by line:\n')
+            for stat in snapshot.statistics('lineno')[:40]:
+                outfile.write(f'{stat}\n')
+            outfile.write('\nmarkov.py allocations:\n')
+            markov_only = snapshot.filter_traces((tracemalloc.Filter(True, '*markov.py'),))
+            for stat in markov_only.statistics('lineno')[:20]:
+                outfile.write(f'{stat}\n')
+        written.append(snapshot_path)
+
+        if previous is not None:
+            diff_path = self._path('memory-diff', 'txt')
+            with open(diff_path, 'w', encoding='utf8') as outfile:
+                for stat in snapshot.compare_to(previous.filter_traces(self._SNAPSHOT_FILTERS), 'lineno')[:40]:
+                    outfile.write(f'{stat}\n')
+            written.append(diff_path)
+        return written
+
+    def install_signal_handlers(self, loop):
+        """SIGUSR1 toggles profiling and SIGUSR2 takes a memory snapshot. Not available on Windows."""
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        loop.add_signal_handler(signal.SIGUSR1, lambda: loop.create_task(self.toggle_async()))
+        loop.add_signal_handler(signal.SIGUSR2, lambda: loop.create_task(self.snapshot_async()))
@@ -0,0 +1,108 @@
+import asyncio
+from collections import Counter, OrderedDict, deque
+from typing import Deque, Optional, Tuple
+
+
+class ResponsePool:
+    """Bounded pool of pre-generated responses for a single Markov brain.
+
+    Unseeded responses are random walks from START, so they can be generated ahead of time while the bot is idle
+    and handed out in O(1). Seeds that get asked for often enough get a small pool of their own. Every pooled
+    response is tagged with the brain's generation when it was made and is thrown away once the brain has learned
+    more than max_staleness new sequences since then, and the whole pool is thrown away when the brain prunes, since
+    pooled walks may take transitions it has just forgotten."""
+    def __init__(
+            self,
+            brain,
+            size: int = 50,
+            max_staleness: int = 25,
+            hot_seed_size: int = 3,
+            max_hot_seeds: int = 32,
+            hot_seed_threshold: int = 3
+    ):
+        self.brain = brain
+        self.size = size
+        self.max_staleness = max_staleness
+        self.hot_seed_size = hot_seed_size
+        self.max_hot_seeds = max_hot_seeds
+        self.hot_seed_threshold = hot_seed_threshold
+
+        self.hits = 0
+        self.misses = 0
+
+        self._unseeded: Deque[Tuple[int, str]] = deque()
+        self._seeded: 'OrderedDict[str, Deque[Tuple[int, str]]]' = OrderedDict()
+        self._seed_requests: Counter = Counter()
+        self._pruned = brain.pruned
+
+    def _drop_if_pruned(self):
+        if self.brain.pruned == self._pruned:
+            return
+        self._pruned = self.brain.pruned
+        self._unseeded.clear()
+        for pool in self._seeded.values():
+            pool.clear()
+
+    def _is_fresh(self, generation: int) -> bool:
+        return self.brain.generation - generation <= self.max_staleness
+
+    def _pool_for_seed(self, seed: str) -> Optional[Deque[Tuple[int, str]]]:
+        """Count a request for seed and return its pool once it's hot enough to deserve one"""
+        pool = self._seeded.get(seed)
+        if pool is not None:
+            self._seeded.move_to_end(seed)
+            return pool
+
+        # crude bound on the request counter so one-off seeds don't pile up forever
+        if len(self._seed_requests) > 32 * self.max_hot_seeds:
+            self._seed_requests.clear()
+        self._seed_requests[seed] += 1
+        if self.hot_seed_size <= 0 or self._seed_requests[seed] < self.hot_seed_threshold:
+            return None
+
+        del self._seed_requests[seed]
+        pool = self._seeded[seed] = deque()
+        if len(self._seeded) > self.max_hot_seeds:
+            self._seeded.popitem(last=False)
+        return pool
+
+    def take(self, seed: Optional[str] = None) -> str:
+        """Hand out a pooled response for seed (or an unseeded one), generating on demand if none are ready"""
+        self._drop_if_pruned()
+        pool = self._unseeded if seed is None else self._pool_for_seed(seed)
+        while pool:
+            generation, text = pool.popleft()
+            if self._is_fresh(generation):
+                self.hits += 1
+                return text
+        self.misses += 1
+        return self.brain.generate_markov_text(seed)
+
+    def _drop_stale(self, pool: Deque[Tuple[int, str]]):
+        # responses are appended in generation order, so the stale ones are always at the front
+        while pool and not self._is_fresh(pool[0][0]):
+            pool.popleft()
+
+    def refill(self, budget: int) -> int:
+        """Generate up to budget responses into whichever pools are short, unseeded first. Returns the number made."""
+        made = 0
+        self._drop_if_pruned()
+        self._drop_stale(self._unseeded)
+        while made < budget and len(self._unseeded) < self.size:
+            self._unseeded.append((self.brain.generation, self.brain.generate_markov_text()))
+            made += 1
+
+        for seed, pool in list(self._seeded.items()):
+            self._drop_stale(pool)
+            while made < budget and len(pool) < self.hot_seed_size:
+                pool.append((self.brain.generation, self.brain.generate_markov_text(seed)))
+                made += 1
+        return made
+
+    async def run(self, idle_interval: float = 1.0, batch_size: int = 5):
+        """Keep the pools topped up, yielding to the event loop between small batches so replies aren't held up"""
+        while True:
+            if self.refill(batch_size) > 0:
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(idle_interval)
@@ -0,0 +1,32 @@
+from typing import Awaitable, Callable, Optional
+
+from slack_bolt.adapter.socket_mode.aiohttp import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp
+
+from outbound_queue import OutboundQueue
+
+# chat.postMessage truncates text past 40k characters but slack recommends staying under 4k, and allows about one
+# message per second per channel
+SLACK_MAX_MESSAGE_LEN = 4000
+
+
+class SlackAdapter:
+    """Slack front-end over socket mode. Only imported by main.py when slack tokens are configured, since slack_bolt
+    and aiohttp are slow to import. Replies come from the respond coroutine, which is main.create_raw_response."""
+    def __init__(self, bot_token: str, app_token: str, respond: Callable[..., Awaitable[Optional[str]]]):
+        self.respond = respond
+        self.app = AsyncApp(token=bot_token)
+        self.app.event("message")(self.handle_slack_message)
+        self.socket_client = AsyncSocketModeHandler(self.app, app_token)
+        self.outbound = OutboundQueue('slack', self._post_message, SLACK_MAX_MESSAGE_LEN, rate=1.0, burst=3)
+
+    async def handle_slack_message(self, payload):
+        response = await self.respond(payload["text"], True)
+        if response and response.strip() != "":
+            self.outbound.enqueue(payload["channel"], payload["channel"], response)
+
+    async def _post_message(self, channel: str, text: str):
+        await self.app.client.chat_postMessage(channel=channel, text=text)
+
+    async def start(self):
+        await self.socket_client.connect_async()
@@ -0,0 +1,54 @@
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Optional
+
+
+class StartupTimer:
+    """Times the phases of startup (imports, brain load, gateway connects) and logs a breakdown once arm() has been
+    called and every phase that was started has finished. Phases may overlap, so they don't necessarily add up to
+    the total."""
+    def __init__(self, started: Optional[float] = None):
+        self.started = started if started is not None else perf_counter()
+        self.phases: Dict[str, float] = dict()
+        self._running: Dict[str, float] = dict()
+        self._armed = False
+        self._reported = False
+
+    def begin(self, name: str):
+        self._running[name] = perf_counter()
+
+    def end(self, name: str, ended: Optional[float] = None):
+        """ended is the perf_counter() when the phase actually finished, if the loop only found out later"""
+        began = self._running.pop(name, None)
+        if began is None:
+            return
+        self.record(name, (ended if ended is not None else perf_counter()) - began)
+        self._maybe_report()
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = seconds
+
+    def arm(self):
+        """Everything that will be timed has been started; report as soon as it's all done"""
+        self._armed = True
+        self._maybe_report()
+
+    def _maybe_report(self):
+        if self._armed and not self._running and not self._reported:
+            self._reported = True
+            logging.info(self.report())
+
+    @contextmanager
+    def phase(self, name: str):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def report(self) -> str:
+        lines = [f'Startup took {perf_counter() - self.started:.2f}s']
+        for name, seconds in self.phases.items():
+            lines.append(f'  {name}: {seconds:.2f}s')
+        return '\n'.join(lines)
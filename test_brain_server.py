@@ -0,0 +1,161 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from brain_server import MAX_FRAME_BYTES, BrainClient, BrainServer, read_frame, write_frame
+from markov import Markov
+from test_graph_pruner import write_corpus
+
+
+async def wait_until(predicate, timeout: float = 5.0):
+    async def poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+class FramingTest(unittest.IsolatedAsyncioTestCase):
+    class _Buffer:
+        def __init__(self):
+            self.data = b''
+
+        def write(self, data: bytes):
+            self.data += data
+
+    async def test_round_trip(self):
+        buffer = self._Buffer()
+        write_frame(buffer, [1, 'respond', 'hello ünïcode', False, True])
+        write_frame(buffer, [0, 'learned', 'abc', 3, [['a', 'b']]])
+        reader = asyncio.StreamReader()
+        reader.feed_data(buffer.data)
+        reader.feed_eof()
+
+        self.assertEqual(await read_frame(reader), [1, 'respond', 'hello ünïcode', False, True])
+        self.assertEqual(await read_frame(reader), [0, 'learned', 'abc', 3, [['a', 'b']]])
+        self.assertIsNone(await read_frame(reader))
+
+    async def test_oversized_frame(self):
+        reader = asyncio.StreamReader()
+        reader.feed_data((MAX_FRAME_BYTES + 1).to_bytes(4, 'big'))
+        with self.assertRaises(ValueError):
+            await read_frame(reader)
+
+
+class BrainServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.corpus = os.path.join(self.tmp.name, 'corpus.txt')
+        write_corpus(self.corpus, lines=200)
+        self.address = 'unix:' + os.path.join(self.tmp.name, 'brain.sock')
+        self.tasks = list()
+        self.server = await self.start_server()
+
+    async def asyncTearDown(self):
+        # clients first, so the server's connections end at EOF rather than by cancellation
+        for task in reversed(self.tasks):
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self.tmp.cleanup()
+
+    def brain(self, output=None) -> Markov:
+        return Markov(self.corpus, output, None, ['bob'])
+
+    async def start_server(self) -> BrainServer:
+        server = BrainServer(self.brain(os.path.join(self.tmp.name, 'brain.out')))
+        self.server_task = asyncio.create_task(server.serve(self.address))
+        self.tasks.append(self.server_task)
+        await wait_until(lambda: os.path.exists(self.address[len('unix:'):]))
+        return server
+
+    async def stop_server(self):
+        self.server_task.cancel()
+        await asyncio.gather(self.server_task, return_exceptions=True)
+        self.tasks.remove(self.server_task)
+        os.remove(self.address[len('unix:'):])
+
+    async def connect(self, **kwargs) -> BrainClient:
+        client = BrainClient(self.address, timeout=5.0, **kwargs)
+        self.tasks.append(asyncio.create_task(client.run(retry_delay=0.01)))
+        return client
+
+    async def test_pipelined_calls(self):
+        client = await self.connect()
+        replies = await asyncio.gather(*(client.call('respond', 'aaa bbb ccc ddd', False, False) for _ in range(10)),
+                                       client.call('ping'))
+
+        self.assertEqual(replies[-1], 'pong')
+        vocabulary = {chr(ord('a') + i) * 3 for i in range(16)}
+        for reply in replies[:-1]:
+            self.assertTrue(reply)
+            self.assertLessEqual(set(reply.split()), vocabulary)
+
+    async def test_error_reply(self):
+        client = await self.connect()
+        with self.assertRaisesRegex(RuntimeError, 'unknown op'):
+            await client.call('nope')
+        # and the connection carries on
+        self.assertEqual(await client.call('ping'), 'pong')
+
+    async def test_replies_matched_by_id(self):
+        await self.stop_server()
+
+        async def reversing_server(reader, writer):
+            requests = [await read_frame(reader) for _ in range(3)]
+            for request_id, op, *args in reversed(requests):
+                write_frame(writer, [request_id, True, args[0]])
+            await writer.drain()
+            await read_frame(reader)
+            writer.close()
+
+        server = await asyncio.start_unix_server(reversing_server, self.address[len('unix:'):])
+        try:
+            client = await self.connect()
+            self.assertEqual(await asyncio.gather(*(client.call('echo', i) for i in range(3))), [0, 1, 2])
+        finally:
+            server.close()
+
+    async def test_replica_follows_learning(self):
+        learner = await self.connect()
+        await learner.call('learn', 'zzone zztwo zzthree')
+        await learner.call('learn', 'yyone yytwo yythree')
+
+        # a replica that has already applied the first sequence only gets the rest replayed
+        replica = self.brain()
+        client = await self.connect(replica=replica)
+        client.replica_offset = 1
+        await wait_until(lambda: client.replica_offset == 2)
+        self.assertFalse(replica.is_seed('zzone'))
+        self.assertTrue(replica.is_seed('yyone'))
+
+        await learner.call('learn', 'xxone xxtwo xxthree')
+        await wait_until(lambda: client.replica_offset == 3)
+        self.assertTrue(replica.is_seed('xxone'))
+        self.assertEqual(client.replica_instance, self.server.instance)
+
+    async def test_replica_reloads_when_server_restarts(self):
+        reloads = list()
+
+        async def reload_replica():
+            reloads.append(True)
+            return self.brain()
+
+        learner = await self.connect()
+        client = await self.connect(replica=self.brain(), reload_replica=reload_replica)
+        await learner.call('learn', 'zzone zztwo zzthree')
+        await wait_until(lambda: client.replica_offset == 1)
+        self.assertTrue(client.replica.is_seed('zzone'))
+
+        await self.stop_server()
+        self.server = await self.start_server()
+        await wait_until(lambda: client.replica_instance == self.server.instance)
+
+        self.assertEqual(len(reloads), 1)
+        self.assertFalse(client.replica.is_seed('zzone'))
+        await learner.call('learn', 'yyone yytwo yythree')
+        await wait_until(lambda: client.replica_offset == 1)
+        self.assertTrue(client.replica.is_seed('yyone'))
+
+
+if __name__ == '__main__':
+    unittest.main()
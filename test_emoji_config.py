@@ -0,0 +1,67 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from emoji_config import EmojiConfig, EmojiMapping, read_emoji_config, write_emoji_config
+
+
+class EmojiConfigTest(unittest.TestCase):
+    def config(self) -> EmojiConfig:
+        return EmojiConfig([
+            EmojiMapping('code.*', 'computer', 1),
+            EmojiMapping('.*', 'shrug', 1),
+            EmojiMapping('code.*', 'keyboard', 2),
+            # a second mapping for the same guild and regex is ignored
+            EmojiMapping('CODE.*', 'ignored', 1),
+        ])
+
+    def test_first_match_per_guild(self):
+        config = self.config()
+        self.assertEqual(config.find_emoji_for_message_token('codebro', 1).emoji_str, 'computer')
+        self.assertEqual(config.find_emoji_for_message_token('town', 1).emoji_str, 'shrug')
+        self.assertEqual(config.find_emoji_for_message_token('codebro', 2).emoji_str, 'keyboard')
+        self.assertIsNone(config.find_emoji_for_message_token('town', 2))
+        self.assertIsNone(config.find_emoji_for_message_token('codebro', 3))
+
+    def test_add_replaces_in_place(self):
+        config = self.config()
+        config.add_mapping(EmojiMapping('Code.*', 'robot', 1))
+        self.assertEqual([m.emoji_str for m in config.get_mappings_for_guild(1)], ['robot', 'shrug'])
+        self.assertEqual(config.find_emoji_for_message_token('codebro', 1).emoji_str, 'robot')
+
+        config.add_mapping(EmojiMapping('bro', 'wave', 3))
+        self.assertEqual(config.find_mapping_via_regex_str('BRO', 3).emoji_str, 'wave')
+        self.assertEqual(len(config.emoji_config_list), 4)
+
+    def test_remove(self):
+        config = self.config()
+        self.assertEqual(config.remove_mappings_for_regex('CODE.*', 1), 1)
+        self.assertEqual(config.remove_mappings_for_regex('code.*', 1), 0)
+        self.assertEqual(config.find_emoji_for_message_token('codebro', 1).emoji_str, 'shrug')
+        self.assertEqual(config.find_emoji_for_message_token('codebro', 2).emoji_str, 'keyboard')
+
+        self.assertEqual(config.remove_mappings_for_regex('code.*', 2), 1)
+        self.assertEqual(config.get_mappings_for_guild(2), [])
+        self.assertEqual(config.remove_mappings_for_regex('code.*', 4), 0)
+
+    def test_write_keeps_file_mode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'emoji_map.yaml')
+            write_emoji_config(filename, self.config())
+            os.chmod(filename, 0o644)
+
+            config = read_emoji_config(filename)
+            config.add_mapping(EmojiMapping('bro', 'wave', 3))
+            write_emoji_config(filename, config)
+
+            self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0o644)
+            saved = read_emoji_config(filename).emoji_config_list
+            self.assertEqual([(m.regex_str, m.emoji_str, m.guild_id) for m in saved],
+                             [('CODE.*', 'computer', 1), ('.*', 'shrug', 1), ('CODE.*', 'keyboard', 2),
+                              ('BRO', 'wave', 3)])
+            self.assertEqual(os.listdir(tmp), ['emoji_map.yaml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
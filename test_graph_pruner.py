@@ -0,0 +1,70 @@
+import os
+import random
+import tempfile
+import unittest
+
+from graph_pruner import GraphPruner
+from markov import START, Markov
+
+
+def write_corpus(path: str, lines: int = 3000, vocabulary: int = 16, seed: int = 1):
+    rng = random.Random(seed)
+    words = [chr(ord('a') + i) * 3 for i in range(vocabulary)]
+    with open(path, 'w', encoding='utf8') as outfile:
+        for _ in range(lines):
+            outfile.write(' '.join(rng.choice(words) for _ in range(rng.randint(2, 12))))
+            outfile.write('\n')
+
+
+class GraphPrunerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.corpus = os.path.join(self.tmp.name, 'corpus.txt')
+        write_corpus(self.corpus)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_every_context_reaches_stop(self, brain: Markov):
+        for key in brain.prunable_keys() + [(START,)]:
+            for next_word, _, _ in brain.edges_from(key):
+                target = brain._edge_target(key, next_word)
+                if target is not None:
+                    self.assertIsNotNone(brain._node_for(target).stats, f'{key} -> {next_word} leads nowhere')
+
+        for key in brain.prunable_keys():
+            context, steps = key, 0
+            while context is not None:
+                node = brain._node_for(context)
+                self.assertIn(node.exit_word, node.stats, f'{key} leads to {context}, which has no way out')
+                context = brain._edge_target(context, node.exit_word)
+                steps += 1
+                self.assertLessEqual(steps, brain.context_count, f'{key} never reaches STOP')
+
+    def test_prunes_under_budget(self):
+        for order in (1, 2, 3):
+            with self.subTest(order=order):
+                brain = Markov(self.corpus, None, None, [], order=order)
+                max_edges = brain.edge_count // 3
+                pruner = GraphPruner(brain, max_edges=max_edges)
+                report = pruner.prune()
+
+                self.assertFalse(pruner.over_budget(), report)
+                self.assertLessEqual(brain.edge_count, max_edges)
+                self.assertEqual(report.edges_remaining, brain.edge_count)
+                self.assert_every_context_reaches_stop(brain)
+                self.assertEqual(sum(len(list(brain.edges_from(k))) for k in brain.prunable_keys()) +
+                                 len(brain._start.next_words), brain.edge_count)
+
+    def test_gives_up_when_budget_cannot_be_met(self):
+        brain = Markov(self.corpus, None, None, [], order=2)
+        pruner = GraphPruner(brain, max_edges=1)
+        pruner.prune()
+
+        self.assertTrue(pruner.over_budget())
+        self.assertEqual(pruner.prune().edges_pruned, 0)
+        self.assert_every_context_reaches_stop(brain)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+from markov import START, STOP, Markov
+from test_graph_pruner import write_corpus
+
+
+def pair_graph(token_seqs):
+    """The graph markov.py kept before the trie: START -> first words, each first word -> second words, and every
+    pair of words -> the words (or STOP) after it"""
+    graph = {START: []}
+
+    def add(key, word):
+        next_words = graph.setdefault(key, [])
+        if word not in next_words:
+            next_words.append(word)
+
+    for seq in token_seqs:
+        if len(seq) < 2:
+            continue
+        words = seq + [STOP]
+        add(START, words[0])
+        add(words[0], words[1])
+        for w1, w2, w3 in zip(words, words[1:], words[2:]):
+            add((w1, w2), w3)
+    return graph
+
+
+class MarkovTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def brain_from(self, lines, order: int) -> Markov:
+        path = os.path.join(self.tmp.name, 'brain.txt')
+        with open(path, 'w', encoding='utf8') as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+        return Markov(path, None, None, [], order=order)
+
+    def test_order_2_matches_pair_graph(self):
+        corpus = os.path.join(self.tmp.name, 'corpus.txt')
+        write_corpus(corpus, lines=500)
+        brain = Markov(corpus, None, None, [], order=2)
+        graph = pair_graph(list(brain.corpus_iter(corpus)))
+
+        for key, next_words in graph.items():
+            if key is START:
+                context = (START,)
+            elif isinstance(key, str):
+                context = (START, key)
+            else:
+                context = key
+            self.assertEqual([word for word, _, _ in brain.edges_from(context)], next_words, context)
+        self.assertEqual(brain.context_count, len(graph))
+        self.assertEqual(brain.edge_count, sum(len(next_words) for next_words in graph.values()))
+
+    def test_seeds_are_sentence_initial(self):
+        for order in (1, 2, 3):
+            with self.subTest(order=order):
+                brain = self.brain_from(['alpha beta gamma', 'delta beta epsilon'], order)
+                self.assertEqual([w for w in ('alpha', 'beta', 'gamma', 'delta', 'epsilon') if brain.is_seed(w)],
+                                 ['alpha', 'delta'])
+                self.assertTrue(brain.generate_markov_text('delta').startswith('delta beta'))
+                for _ in range(20):
+                    self.assertIn(brain.generate_markov_text('beta').split()[0], ('alpha', 'delta'))
+                    self.assertIn(brain.create_response('beta gamma epsilon beta gamma').split()[0],
+                                  ('alpha', 'delta'))
+
+    def test_backoff(self):
+        brain = self.brain_from(['alpha beta gamma', 'delta beta epsilon'], 3)
+        # an unseen context falls through to its longest suffix with transitions of its own
+        self.assertEqual(brain._next_word(('zeta', START, 'delta')), 'beta')
+        # ('alpha', 'beta') only exists as the prefix of ('alpha', 'beta', 'gamma'), so it's skipped too
+        self.assertIs(brain._next_word(('zeta', 'alpha', 'beta')), STOP)
+        self.assertIs(brain._next_word(('zeta', 'eta', 'theta')), STOP)
+        self.assertIs(brain._next_word(('alpha', 'beta', 'gamma')), STOP)
+
+
+if __name__ == '__main__':
+    unittest.main()
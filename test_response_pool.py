@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+
+from graph_pruner import GraphPruner
+from markov import Markov
+from response_pool import ResponsePool
+from test_graph_pruner import write_corpus
+
+
+class ResponsePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        corpus = os.path.join(self.tmp.name, 'corpus.txt')
+        write_corpus(corpus, lines=500)
+        self.brain = Markov(corpus, None, None, [])
+        self.seeds = sorted(self.brain._start.stats)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_unseeded_hits(self):
+        pool = ResponsePool(self.brain, size=5)
+        self.assertEqual(pool.refill(100), 5)
+        self.assertEqual(pool.refill(100), 0)
+        for _ in range(5):
+            pool.take()
+        self.assertEqual((pool.hits, pool.misses), (5, 0))
+        pool.take()
+        self.assertEqual((pool.hits, pool.misses), (5, 1))
+
+    def test_hot_seed_promotion(self):
+        pool = ResponsePool(self.brain, size=0, hot_seed_size=2, hot_seed_threshold=3)
+        seed = self.seeds[0]
+        for _ in range(2):
+            pool.take(seed)
+        # not hot yet, so there's nothing to refill
+        self.assertEqual(pool.refill(100), 0)
+
+        pool.take(seed)
+        self.assertEqual(pool.refill(100), 2)
+        self.assertTrue(pool.take(seed).startswith(seed))
+        self.assertTrue(pool.take(seed).startswith(seed))
+        self.assertEqual((pool.hits, pool.misses), (2, 3))
+
+    def test_hot_seeds_evicted_least_recently_used(self):
+        pool = ResponsePool(self.brain, size=0, hot_seed_size=1, max_hot_seeds=2, hot_seed_threshold=1)
+        first, second, third = self.seeds[:3]
+        pool.take(first)
+        pool.take(second)
+        pool.take(first)
+        pool.take(third)
+        self.assertEqual(list(pool._seeded), [first, third])
+
+    def test_stale_responses_dropped(self):
+        pool = ResponsePool(self.brain, size=3, max_staleness=2)
+        pool.refill(100)
+        for i in range(3):
+            self.brain.update_graph_and_corpus([[f'new{i}', 'words', f'here{i}']])
+        self.assertEqual(pool.refill(100), 3)
+
+        for i in range(3, 6):
+            self.brain.update_graph_and_corpus([[f'new{i}', 'words', f'here{i}']])
+        pool.take()
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+
+    def test_dropped_after_pruning(self):
+        pool = ResponsePool(self.brain, size=5)
+        pool.refill(100)
+        GraphPruner(self.brain, max_edges=self.brain.edge_count // 2).prune()
+
+        pool.take()
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+        self.assertEqual(pool.refill(100), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()